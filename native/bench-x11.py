@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""
+Benchmarks x11_window_control against a throwaway Xvfb server.
+
+A minimal EWMH window manager (MiniWM below) runs on its own connection and maintains
+_NET_CLIENT_LIST and _NET_WM_STATE, then for each window count the benchmark creates that many
+client windows with generated _NET_WM_NAMEs and measures:
+    - how long the event-driven window index takes to pick them up
+    - find_app_window() / is_app_window_minimized() latency and round trips
+    - a full (batched) search_windows() scan, for comparison
+    - minimize/restore latency, until the window manager applied the new state
+
+Results are written as JSON, to compare runs and catch regressions:
+
+    ./bench-x11.py --counts 10,100,1000 --repeat 200 --output bench-x11.json
+
+Needs Xvfb (and python-xlib).
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+import Xlib.display
+import Xlib.error
+import Xlib.X
+import Xlib.Xatom
+import Xlib.Xutil
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_support import percentile, start_xvfb, stop_xvfb
+
+log = lambda msg: print(f"**** {msg}", file=sys.stderr, flush=True)
+
+
+class MiniWM:
+    """
+    Just enough of an EWMH window manager for the benchmark: maps windows, keeps
+    _NET_CLIENT_LIST current and applies the _NET_WM_STATE, WM_CHANGE_STATE,
+    _NET_ACTIVE_WINDOW and _NET_CLOSE_WINDOW client messages.
+    """
+
+    def __init__(self):
+        self.d = Xlib.display.Display()
+        self.root = self.d.screen().root
+        self.atom = self.d.get_atom
+        self.clients = []
+        self.root.change_attributes(
+            event_mask=Xlib.X.SubstructureRedirectMask | Xlib.X.SubstructureNotifyMask
+        )
+        check = self.root.create_window(-1, -1, 1, 1, 0, Xlib.X.CopyFromParent)
+        for w in (self.root, check):
+            w.change_property(
+                self.atom("_NET_SUPPORTING_WM_CHECK"), Xlib.Xatom.WINDOW, 32, [check.id]
+            )
+        check.change_property(self.atom("_NET_WM_NAME"), self.atom("UTF8_STRING"), 8, b"MiniWM")
+        self._update_client_list()
+        self.d.sync()
+        threading.Thread(target=self._run, name="mini-wm", daemon=True).start()
+
+    def _update_client_list(self):
+        ids = [w.id for w in self.clients]
+        self.root.change_property(self.atom("_NET_CLIENT_LIST"), Xlib.Xatom.WINDOW, 32, ids)
+
+    def _get_state(self, w):
+        prop = w.get_full_property(self.atom("_NET_WM_STATE"), Xlib.Xatom.ATOM)
+        return list(prop.value) if prop else []
+
+    def _change_state(self, w, action, *atoms):
+        state = self._get_state(w)
+        for a in filter(None, atoms):
+            present = a in state
+            if action == 1 or (action == 2 and not present):
+                present or state.append(a)
+            elif present:
+                state.remove(a)
+        w.change_property(self.atom("_NET_WM_STATE"), Xlib.Xatom.ATOM, 32, state)
+
+    def _run(self):
+        try:
+            while True:
+                self._handle(self.d.next_event())
+        except Xlib.error.ConnectionClosedError:
+            pass
+
+    def _handle(self, ev):
+        if ev.type == Xlib.X.MapRequest:
+            ev.window.map()
+            if ev.window not in self.clients:
+                self.clients.append(ev.window)
+                self._update_client_list()
+        elif ev.type == Xlib.X.ConfigureRequest:
+            ev.window.configure(x=ev.x, y=ev.y, width=ev.width, height=ev.height)
+        elif ev.type == Xlib.X.DestroyNotify:
+            if ev.window in self.clients:
+                self.clients.remove(ev.window)
+                self._update_client_list()
+        elif ev.type == Xlib.X.ClientMessage:
+            _, data = ev.data
+            hidden = self.atom("_NET_WM_STATE_HIDDEN")
+            if ev.client_type == self.atom("WM_CHANGE_STATE") and data[0] == Xlib.Xutil.IconicState:
+                self._change_state(ev.window, 1, hidden)
+            elif ev.client_type == self.atom("_NET_WM_STATE"):
+                self._change_state(ev.window, data[0], data[1], data[2])
+            elif ev.client_type == self.atom("_NET_ACTIVE_WINDOW"):
+                self._change_state(ev.window, 0, hidden)
+                self.root.change_property(
+                    self.atom("_NET_ACTIVE_WINDOW"), Xlib.Xatom.WINDOW, 32, [ev.window.id]
+                )
+            elif ev.client_type == self.atom("_NET_CLOSE_WINDOW"):
+                ev.window.destroy()
+        self.d.flush()
+
+
+class ClientApp:
+    """Plays the browser: owns the benchmark windows"""
+
+    def __init__(self):
+        self.d = Xlib.display.Display()
+        self.root = self.d.screen().root
+
+    def create_windows(self, count, run_id):
+        windows = []
+        for i in range(count):
+            w = self.root.create_window(0, 0, 200, 100, 0, self.d.screen().root_depth)
+            title = f"Bench window {i} <TA#app{i}@{run_id}> - Browser"
+            w.change_property(
+                self.d.get_atom("_NET_WM_NAME"), self.d.get_atom("UTF8_STRING"), 8, title.encode()
+            )
+            w.set_wm_name(title)
+            w.map()
+            windows.append(w)
+        self.d.flush()
+        return windows
+
+    def destroy_windows(self, windows):
+        for w in windows:
+            w.destroy()
+        self.d.sync()
+
+
+def summarize(name, count, samples_s, round_trips=None):
+    ms = [s * 1000 for s in samples_s]
+    result = {
+        "metric": name,
+        "windows": count,
+        "samples": len(ms),
+        "p50_ms": round(percentile(ms, 50), 4),
+        "p99_ms": round(percentile(ms, 99), 4),
+        "max_ms": round(max(ms), 4),
+    }
+    if round_trips is not None:
+        result["round_trips"] = round_trips
+    log(
+        f"{name:<24} windows={count:<5} p50={result['p50_ms']:.3f}ms"
+        f" p99={result['p99_ms']:.3f}ms {round_trips=}"
+    )
+    return result
+
+
+def wait_until(predicate, timeout=30):
+    started = time.perf_counter()
+    while not predicate():
+        if time.perf_counter() - started > timeout:
+            raise TimeoutError()
+        time.sleep(0.0005)
+    return time.perf_counter() - started
+
+
+def bench(counts, repeat, actions):
+    import x11_window_control as x11
+
+    started = time.perf_counter()
+    window_ctl = x11.X11WindowControl()
+    results = [summarize("startup", 0, [time.perf_counter() - started], dict(x11.round_trips.last))]
+    client = ClientApp()
+    for run_no, count in enumerate(counts):
+        run_id = f"r{run_no}"
+        windows = client.create_windows(count, run_id)
+        ids = {w.id for w in windows}
+
+        def _indexed():
+            window_ctl.process_events()
+            return ids <= window_ctl.window_index.windows.keys()
+
+        index_sync = wait_until(_indexed)
+        results.append(summarize("index_sync", count, [index_sync]))
+
+        samples = []
+        for _ in range(repeat):
+            i = random.randrange(count)
+            t = time.perf_counter()
+            w = window_ctl.find_app_window(f"<TA#app{i}@{run_id}>")
+            samples.append(time.perf_counter() - t)
+            assert w is not None and w.id == windows[i].id, f"lookup of window {i} failed"
+        results.append(
+            summarize("find_app_window", count, samples, x11.round_trips.last["find_app_window"])
+        )
+
+        samples = []
+        for _ in range(max(1, repeat // 10)):
+            i = random.randrange(count)
+            t = time.perf_counter()
+            with x11.round_trips.operation("search_windows"):
+                found = next(x11.search_windows(name=f"<TA#app{i}@{run_id}>"), None)
+            samples.append(time.perf_counter() - t)
+            assert found is not None
+        results.append(
+            summarize(
+                "search_windows (scan)", count, samples, x11.round_trips.last["search_windows"]
+            )
+        )
+
+        samples = []
+        for _ in range(repeat):
+            w = windows[random.randrange(count)]
+            t = time.perf_counter()
+            window_ctl.is_app_window_minimized(w)
+            samples.append(time.perf_counter() - t)
+        results.append(
+            summarize(
+                "is_app_window_minimized",
+                count,
+                samples,
+                x11.round_trips.last["is_app_window_minimized"],
+            )
+        )
+
+        hidden = x11.atoms["_NET_WM_STATE_HIDDEN"]
+        minimize_samples, restore_samples = [], []
+        for _ in range(actions):
+            w = windows[random.randrange(count)]
+            t = time.perf_counter()
+            window_ctl.minimize_app_window(w)
+            wait_until(lambda: hidden in x11.get_net_wm_state_atoms(w))
+            minimize_samples.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            window_ctl.restore_app_window(w)
+            wait_until(lambda: hidden not in x11.get_net_wm_state_atoms(w))
+            restore_samples.append(time.perf_counter() - t)
+        results.append(
+            summarize(
+                "minimize_app_window",
+                count,
+                minimize_samples,
+                x11.round_trips.last["minimize_app_window"],
+            )
+        )
+        results.append(
+            summarize(
+                "restore_app_window",
+                count,
+                restore_samples,
+                x11.round_trips.last["restore_app_window"],
+            )
+        )
+
+        client.destroy_windows(windows)
+        wait_until(
+            lambda: window_ctl.process_events()
+            or not (ids & window_ctl.window_index.windows.keys())
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--counts", default="10,100,1000", help="window counts (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=200, help="lookups per count (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--actions",
+        type=int,
+        default=20,
+        help="minimize/restore cycles per count (default: %(default)s)",
+    )
+    parser.add_argument("--output", help="JSON results file (default: stdout)")
+    parser.add_argument(
+        "--display", help="use this X display instead of starting Xvfb (and MiniWM)"
+    )
+    args = parser.parse_args()
+
+    xvfb = None
+    if args.display:
+        os.environ["DISPLAY"] = args.display
+    else:
+        xvfb, os.environ["DISPLAY"] = start_xvfb()
+        log(f"Xvfb started on {os.environ['DISPLAY']}")
+    try:
+        if xvfb:
+            MiniWM()
+        results = bench([int(c) for c in args.counts.split(",")], args.repeat, args.actions)
+    finally:
+        if xvfb:
+            stop_xvfb(xvfb)
+
+    report = {
+        "benchmark": "x11_window_control",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""Helpers shared by the benchmark scripts, bench-x11.py and exec-dev.py --bench"""
+
+import os
+import subprocess
+
+
+def start_xvfb() -> tuple[subprocess.Popen, str]:
+    """Starts Xvfb on a free display. Returns the process and its DISPLAY"""
+    read_fd, write_fd = os.pipe()
+    proc = subprocess.Popen(
+        ["Xvfb", "-displayfd", str(write_fd), "-screen", "0", "1280x1024x24", "-nolisten", "tcp"],
+        pass_fds=[write_fd],
+        stderr=subprocess.DEVNULL,
+    )
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        display_no = f.readline().strip()
+    if not display_no:
+        proc.kill()
+        raise RuntimeError("Xvfb did not start")
+    return proc, f":{display_no}"
+
+
+def stop_xvfb(proc: subprocess.Popen):
+    proc.terminate()
+    proc.wait()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
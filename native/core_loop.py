@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger("main")
+
+
+class CoreLoop:
+    """
+    asyncio event loop running on its own thread.
+
+    The core loop owns the native messaging I/O, so that it never waits on (or stalls) the
+    Qt/GTK loop, which is left with the tray UI only; the X11 worker runs on another instance
+    (see x11_worker.X11Worker). It exposes the same io-watch interface as the loops returned by
+    SystrayIcon.get_loop(). Except for call_soon_threadsafe(), methods must be called from the
+    loop's thread.
+    """
+
+    def __init__(self, name="tabapps-core"):
+        self.aio = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.aio)
+        try:
+            self.aio.run_forever()
+        finally:
+            logger.debug("Core loop stopped")
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.aio.call_soon_threadsafe(self.aio.stop)
+            self.thread.join(timeout=1)
+
+    def in_core_thread(self) -> bool:
+        return threading.current_thread() is self.thread
+
+    def register_io_watch(self, fd, on_ready, writable=False):
+        if writable:
+            self.aio.add_writer(fd, on_ready)
+        else:
+            self.aio.add_reader(fd, on_ready)
+        return fd, writable
+
+    def unregister_io_watch(self, watch):
+        fd, writable = watch
+        if writable:
+            self.aio.remove_writer(fd)
+        else:
+            self.aio.remove_reader(fd)
+
+    def call_soon(self, cb, *args):
+        return self.aio.call_soon(cb, *args)
+
+    def call_later(self, delay, cb, *args):
+        return self.aio.call_later(delay, cb, *args)
+
+    def call_soon_threadsafe(self, cb, *args):
+        return self.aio.call_soon_threadsafe(cb, *args)
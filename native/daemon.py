@@ -0,0 +1,127 @@
+import contextlib
+import fcntl
+import logging
+import os
+import pathlib
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger("main")
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def socket_path() -> pathlib.Path:
+    """Per user, and per X display, as the daemon owns one display connection"""
+    display = (os.environ.get("DISPLAY") or "").replace("/", "_").lstrip(":") or "none"
+    if runtime_dir := os.environ.get("XDG_RUNTIME_DIR"):
+        return pathlib.Path(runtime_dir, f"tabapps-companion-{display}.sock")
+    return pathlib.Path(f"/tmp/tabapps-{os.getuid()}", f"companion-{display}.sock")
+
+
+def connect(path: pathlib.Path = None) -> socket.socket | None:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path or socket_path()))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def spawn_daemon(args=()) -> subprocess.Popen:
+    """Starts `main.py --daemon` in a session of its own, so that it outlives the native host"""
+    from icon_cache import xdg_cache_dir
+
+    log_file = pathlib.Path(os.environ.get("TABAPPS_STDERR_FILE") or xdg_cache_dir() / "daemon.log")
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_file, "ab") as stderr:
+        return subprocess.Popen(
+            [sys.executable, MAIN_SCRIPT, "--daemon", *args],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+            cwd=os.path.dirname(MAIN_SCRIPT),
+            start_new_session=True,
+        )
+
+
+def connect_or_spawn(args=(), timeout=15) -> socket.socket:
+    """Connects to the daemon, starting it first if it is not running"""
+    path = socket_path()
+    if sock := connect(path):
+        return sock
+    proc = spawn_daemon(args)
+    # reaped as soon as it exits: right away when another daemon won the race to start, else
+    # it would stay a zombie of a long-lived native host
+    threading.Thread(target=proc.wait, name="tabapps-reaper", daemon=True).start()
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+        if sock := connect(path):
+            return sock
+        if proc.poll():  # 0: another daemon won the race to start, and is about to listen
+            raise ConnectionError(f"The companion daemon exited with code {proc.returncode}")
+    raise TimeoutError(f"The companion daemon did not start listening on {path} in {timeout}s")
+
+
+class DaemonServer:
+    """
+    Listening socket of the companion daemon, for the native host shims (see shim.py).
+
+    A lock file next to the socket is held for the life of the daemon, so that exactly one
+    daemon serves a given path, even when several shims start one at the same time.
+    """
+
+    def __init__(self, path: pathlib.Path = None):
+        self.path = path or socket_path()
+        self._lock_file = None
+        self._sock: socket.socket = None
+        self.connections = 0
+
+    def bind(self) -> bool:
+        """Starts listening. False if another daemon is already serving the path"""
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if self.path.parent.stat().st_uid != os.getuid():
+            raise PermissionError(f"{self.path.parent} is not owned by the current user")
+        self._lock_file = open(self.path.with_suffix(".lock"), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            return False
+        with contextlib.suppress(FileNotFoundError):
+            self.path.unlink()  # left over by a daemon that is gone
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(str(self.path))
+        os.chmod(self.path, 0o600)
+        self._sock.listen(8)
+        self._sock.setblocking(False)
+        logger.info("Companion daemon listening on %s", self.path)
+        return True
+
+    def serve(self, loop, on_connection):
+        """Calls `on_connection(conn)`, on `loop`, for every shim connecting"""
+
+        def _on_acceptable(*args):
+            while True:
+                try:
+                    conn, _ = self._sock.accept()
+                except BlockingIOError:
+                    return
+                self.connections += 1
+                on_connection(conn)
+
+        loop.register_io_watch(self._sock.fileno(), _on_acceptable)
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            with contextlib.suppress(FileNotFoundError):
+                self.path.unlink()
+            self._lock_file.close()
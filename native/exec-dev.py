@@ -1,4 +1,14 @@
 #!/usr/bin/env python
+"""
+Runs main.py over a socketpair, as the browser would.
+
+Interactive by default. With --bench, it instead sends a mix of messages (flat out, or at a fixed
+--rate) and reports the ping => pong latency, the throughput and the peak RSS of main.py as JSON:
+
+    ./exec-dev.py --bench --xvfb --mix ping=6,config=1,app-launch=2,window-action=1 --count 20000
+"""
+import argparse
+import collections
 import json
 import os
 import signal
@@ -7,27 +17,64 @@ import struct
 import subprocess
 import sys
 import threading
+import time
 from functools import cache
 
+from bench_support import percentile, start_xvfb, stop_xvfb
+
 log = lambda msg: print(f"**** {msg}", file=sys.stderr, flush=True)
 
+parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+)
+parser.add_argument("--bench", action="store_true", help="run the benchmark instead of the REPL")
+parser.add_argument("--mix", default="ping=1", help="message weights (default: %(default)s)")
+parser.add_argument(
+    "--count", type=int, default=10000, help="messages to send (default: %(default)s)"
+)
+parser.add_argument(
+    "--rate", type=float, default=0, help="messages per second, 0 for flat out (default)"
+)
+parser.add_argument("--apps", type=int, default=10, help="distinct app ids (default: %(default)s)")
+parser.add_argument("--output", help="JSON results file (default: stdout)")
+parser.add_argument("--child-log", help="main.py log file (default: discarded in --bench mode)")
+parser.add_argument("--xvfb", action="store_true", help="run main.py on a private Xvfb display")
+args = parser.parse_args()
+
 s1, s2 = socket.socketpair()
 
 os.environ["LC_ALL"] = "C"
-os.chdir(os.path.dirname(__file__))
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
-proc = subprocess.Popen(args=["python", "./main.py"], stdin=s2, stdout=s2)
+xvfb = None
+if args.xvfb:
+    xvfb, os.environ["DISPLAY"] = start_xvfb()
+    log(f"Xvfb started on {os.environ['DISPLAY']}")
+
+child_stderr = None
+if not args.bench:
+    # interactive: every log record straight to the terminal, not kept in main.py's ring buffer
+    os.environ.setdefault("TABAPPS_LOG_BUFFER", "0")
+if args.child_log:
+    child_stderr = open(args.child_log, "w")
+elif args.bench:
+    child_stderr = subprocess.DEVNULL
+
+proc = subprocess.Popen(args=["python", "./main.py"], stdin=s2, stdout=s2, stderr=child_stderr)
 
 
 # handle keyboard interrupt
 @cache
 def die():
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
     if proc.poll() is None:
         proc.terminate()
         log("Waiting for subprocess to terminate...")
         if proc.wait(0.1) is None:
             log("Subprocess did not terminate, killing it...")
             proc.kill()
+    if xvfb:
+        stop_xvfb(xvfb)
     log("Exiting wrapper")
     sys.exit(proc.wait())
 
@@ -61,6 +108,122 @@ def proc_read_loop():
         die()
 
 
+def read_frames():
+    """Yields the messages from main.py, until EOF"""
+    f = s1.makefile("rb")
+    while len(length_data := f.read(4)) == 4:
+        msg_len = struct.unpack("@I", length_data)[0]
+        yield json.loads(f.read(msg_len))
+
+
+def peak_rss_kb():
+    with open(f"/proc/{proc.pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+
+
+def bench_message(type, i):
+    app_id = f"bench{i % args.apps}"
+    if type == "ping":
+        return {"type": "ping"}
+    if type == "config":
+        apps = [{"id": f"bench{n}", "label": f"Bench app {n}"} for n in range(args.apps)]
+        return {"type": "config", "apps": apps}
+    if type == "app-launch":
+        return {"type": "app-launch", "appId": app_id, "windowTitleFingerprint": f"<TA#{app_id}>"}
+    if type == "window-action":
+        return {"type": "window-action", "appId": app_id, "action": ("iconify", "restore")[i % 2]}
+    raise ValueError(f"Unknown message type: {type}")
+
+
+def run_bench():
+    weights = {t: int(w) for t, w in (item.split("=") for item in args.mix.split(","))}
+    types = [t for t, w in weights.items() for _ in range(w)]
+    # pre-encoded, so that the sender measures main.py and not json.dumps()
+    frames = []
+    for i in range(args.count):
+        data = json.dumps(bench_message(types[i % len(types)], i), separators=(",", ":")).encode()
+        frames.append((types[i % len(types)], struct.pack("@I", len(data)) + data))
+    frames.append(("ping", struct.pack("@I", 15) + b'{"type":"ping"}'))  # barrier: the last reply
+
+    started = time.perf_counter()
+    replies = read_frames()
+    ready = next(replies, None)
+    if not ready or ready["type"] != "ready":
+        raise RuntimeError(f"Unexpected first message: {ready}")
+    startup_s = time.perf_counter() - started
+    send(bench_message("config", 0))
+
+    ping_times = collections.deque()
+    latencies, received = [], collections.Counter()
+    done = threading.Event()
+    pongs_expected = sum(1 for t, _ in frames if t == "ping")
+
+    def _read():
+        for msg in replies:
+            received[msg["type"]] += 1
+            if msg["type"] == "pong":
+                latencies.append(time.perf_counter() - ping_times.popleft())
+                if len(latencies) == pongs_expected:
+                    break
+        done.set()
+
+    threading.Thread(target=_read, daemon=True).start()
+    sent = collections.Counter()
+    started = time.perf_counter()
+    for i, (type, frame) in enumerate(frames):
+        if args.rate and (delay := started + i / args.rate - time.perf_counter()) > 0:
+            time.sleep(delay)
+        if type == "ping":
+            ping_times.append(time.perf_counter())
+        s1.sendall(frame)
+        sent[type] += 1
+    send_s = time.perf_counter() - started
+    if not done.wait(timeout=60):
+        raise TimeoutError(f"Only {len(latencies)}/{pongs_expected} pongs were received")
+    total_s = time.perf_counter() - started
+
+    ms = [s * 1000 for s in latencies]
+    report = {
+        "benchmark": "native_messaging",
+        "timestamp": time.time(),
+        "mix": weights,
+        "rate": args.rate or None,
+        "startup_ms": round(startup_s * 1000, 2),
+        "messages": sum(sent.values()),
+        "sent": dict(sent),
+        "received": dict(received),
+        "send_s": round(send_s, 4),
+        "total_s": round(total_s, 4),
+        "msgs_per_s": round(sum(sent.values()) / total_s, 1),
+        "ping_p50_ms": round(percentile(ms, 50), 4),
+        "ping_p99_ms": round(percentile(ms, 99), 4),
+        "ping_max_ms": round(max(ms), 4),
+        "peak_rss_kb": peak_rss_kb(),
+    }
+    log(
+        f"{report['messages']} messages in {total_s:.3f}s: {report['msgs_per_s']} msg/s,"
+        f" ping p50={report['ping_p50_ms']}ms p99={report['ping_p99_ms']}ms,"
+        f" peak RSS={report['peak_rss_kb']} kB"
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if args.bench:
+    try:
+        run_bench()
+        s1.shutdown(socket.SHUT_WR)  # EOF: main.py exits on its own
+        proc.wait(5)
+    finally:
+        die()
+
+
 def proc_write_loop():
     while data := sys.stdin.readline():
         try:
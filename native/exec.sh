@@ -10,4 +10,13 @@ if [ -n "$TABAPPS_STDERR_FILE" ]; then
 fi
 
 cd "$(dirname "$0")"
-exec python main.py
+set --
+if [ "$TABAPPS_STARTUP_REPORT" = "true" ]; then
+    set -- --startup-report
+fi
+# TABAPPS_DAEMON=false: a standalone companion per browser connection, instead of the shim to
+# the per-user companion daemon
+if [ "$TABAPPS_DAEMON" = "false" ]; then
+    exec python main.py "$@"
+fi
+exec python shim.py "$@"
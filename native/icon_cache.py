@@ -0,0 +1,210 @@
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import pathlib
+import threading
+import time
+from functools import partial
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger("main")
+
+
+def xdg_cache_dir() -> pathlib.Path:
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return pathlib.Path(xdg_cache_home, "tabapps")
+
+
+def default_cache_dir() -> pathlib.Path:
+    return xdg_cache_dir() / "icons"
+
+
+class IconCache:
+    """
+    Persistent, content-addressed cache of the app icons, with a worker pool to fetch them.
+
+    Icon files are stored once per content hash. index.json maps each url to its file and to
+    the ETag/Last-Modified validators, which are used for conditional requests on refetch.
+    The total size is bounded: the least recently used urls are evicted first, except for the
+    files pinned as in use (see pin()) and the one just fetched.
+    """
+
+    def __init__(
+        self,
+        cache_dir: pathlib.Path | None = None,
+        *,
+        max_cache_size=20 * 1024 * 1024,
+        max_icon_size=500 * 1024,
+        timeout=5,
+        max_workers=4,
+    ):
+        self.cache_dir = pathlib.Path(cache_dir or default_cache_dir())
+        self.max_cache_size = max_cache_size
+        self.max_icon_size = max_icon_size
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tabapps-icon"
+        )
+        self._lock = threading.Lock()
+        self._inflight: dict[str, concurrent.futures.Future] = {}
+        self._index_file = self.cache_dir / "index.json"
+        self._index: dict[str, dict] = {}
+        self._pinned: set[str] = set()  # names of the files in use, never evicted
+        self.stats = collections.Counter()  # hits, misses, fetched, not_modified, stale, errors
+        with contextlib.suppress(FileNotFoundError, ValueError):
+            self._index = json.loads(self._index_file.read_text())
+
+    def get_cached(self, url) -> pathlib.Path | None:
+        with self._lock:
+            if (entry := self._index.get(url)) and (f := self.cache_dir / entry["file"]).exists():
+                self.stats["hits"] += 1
+                entry["last_used"] = time.time()  # saved with the next change of the index
+                return f
+            self.stats["misses"] += 1
+        return None
+
+    def fetch_async(self, url, on_done=None) -> concurrent.futures.Future:
+        """
+        Fetches `url` on the worker pool. `on_done(path, error)` is called from a worker thread.
+        Concurrent requests of the same url share one download.
+        """
+        with self._lock:
+            if not (future := self._inflight.get(url)):
+                future = self._executor.submit(self.fetch, url)
+                self._inflight[url] = future
+                future.add_done_callback(partial(self._on_fetched, url))
+        if on_done:
+            future.add_done_callback(lambda f: on_done(*self._result(f)))
+        return future
+
+    def _on_fetched(self, url, future):
+        self._inflight.pop(url, None)
+        if not future.cancelled() and future.exception():
+            self.stats["errors"] += 1
+
+    @staticmethod
+    def _result(future):
+        if e := future.exception():
+            return None, e
+        return future.result(), None
+
+    def fetch(self, url) -> pathlib.Path:
+        """Downloads (or revalidates) `url` and returns the cached file. Blocking"""
+        with self._lock:
+            entry = dict(self._index.get(url) or {})
+        cached_file = self.cache_dir / entry["file"] if entry else None
+        if cached_file and not cached_file.exists():
+            entry, cached_file = {}, None
+
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            with contextlib.closing(
+                urlopen(Request(url, headers=headers), timeout=self.timeout)
+            ) as resp:
+                info = resp.info()
+                content = self._read_capped(resp, info.get("Content-Length"))
+        except HTTPError as e:
+            if e.code == 304 and cached_file:
+                logger.debug(f"Icon not modified: {url}")
+                self.stats["not_modified"] += 1
+                self._touch(url)
+                return cached_file
+            raise
+        except OSError:
+            if cached_file:
+                logger.warning(f"Could not refetch icon {url}, using the cached one", exc_info=True)
+                self.stats["stale"] += 1
+                return cached_file
+            raise
+
+        digest = hashlib.sha256(content).hexdigest()
+        ext = pathlib.PurePosixPath(urlparse(url).path).suffix
+        if not ext or len(ext) > 5:
+            ext = mimetypes.guess_extension(info.get_content_type() or "") or ""
+        fname = self.cache_dir / (digest + ext)
+        if not fname.exists():
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp = fname.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp.write_bytes(content)
+            os.replace(tmp, fname)
+        logger.info(f"Fetched icon {url} ({len(content)} bytes) => {fname}")
+        self.stats["fetched"] += 1
+
+        with self._lock:
+            self._index[url] = {
+                "file": fname.name,
+                "size": len(content),
+                "etag": info.get("ETag"),
+                "last_modified": info.get("Last-Modified"),
+                "last_used": time.time(),
+            }
+            self._evict(keep=url)
+            self._save_index()
+        return fname
+
+    def _read_capped(self, resp, content_length) -> bytes:
+        if content_length and int(content_length) > self.max_icon_size:
+            raise ValueError(f"Icon file too large: {content_length}")
+        # Content-Length may be missing (or wrong): enforce the cap while streaming as well
+        chunks, size = [], 0
+        while chunk := resp.read(8 * 1024):
+            size += len(chunk)
+            if size > self.max_icon_size:
+                raise ValueError(f"Icon file too large: more than {self.max_icon_size} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _touch(self, url):
+        with self._lock:
+            if entry := self._index.get(url):
+                entry["last_used"] = time.time()
+                self._save_index()
+
+    def pin(self, path):
+        """Keeps the cached file `path` from being evicted while an app uses it, see unpin()"""
+        with self._lock:
+            self._pinned.add(pathlib.Path(path).name)
+
+    def unpin(self, path):
+        with self._lock:
+            self._pinned.discard(pathlib.Path(path).name)
+
+    def _evict(self, keep=None):
+        """
+        Drops least recently used urls until the files fit in max_cache_size, but neither `keep`
+        nor the pinned files: those may go over the limit. Needs _lock
+        """
+        file_sizes = {e["file"]: e["size"] for e in self._index.values()}
+        total = sum(file_sizes.values())
+        for url, entry in sorted(self._index.items(), key=lambda it: it[1]["last_used"]):
+            if total <= self.max_cache_size:
+                break
+            if url == keep or entry["file"] in self._pinned:
+                continue
+            del self._index[url]
+            if not any(e["file"] == entry["file"] for e in self._index.values()):
+                total -= file_sizes[entry["file"]]
+                logger.debug(f"Evicting cached icon {entry['file']} of {url}")
+                with contextlib.suppress(FileNotFoundError):
+                    (self.cache_dir / entry["file"]).unlink()
+
+    def _save_index(self):
+        """Needs _lock"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self._index_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self._index))
+        os.replace(tmp, self._index_file)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
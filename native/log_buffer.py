@@ -0,0 +1,111 @@
+import collections
+import logging
+import sys
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+_SCALAR_TYPES = {str, int, float, bool, bytes, type(None)}
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the last `capacity` records in memory, unformatted: a record only costs its
+    LogRecord until it is written out. Records whose arguments are not all immutable scalars
+    have their message rendered when buffered, so that they show the state at logging time
+    and do not keep the objects alive. Records at or above `passthrough_level` are written to
+    `target` right away; one at or above `flush_level` first writes out the buffered records
+    that led to it. dump() writes the buffer out on demand (Dump menu, `logs` message).
+    """
+
+    def __init__(
+        self,
+        target: logging.Handler,
+        capacity=2000,
+        flush_level=logging.ERROR,
+        passthrough_level=logging.WARNING,
+    ):
+        super().__init__()
+        self.target = target
+        self.flush_level = flush_level
+        self.passthrough_level = passthrough_level
+        self._records: collections.deque[logging.LogRecord] = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        if record.levelno >= self.flush_level:
+            self.dump()  # the context of the error first
+        if record.levelno >= min(self.passthrough_level, self.flush_level):
+            self.target.handle(record)
+        else:
+            self._records.append(self._snapshot(record))
+
+    @staticmethod
+    def _snapshot(record) -> logging.LogRecord:
+        args = record.args.values() if isinstance(record.args, dict) else record.args or ()
+        if not all(type(arg) in _SCALAR_TYPES for arg in args):
+            record.msg, record.args = record.getMessage(), None
+        return record
+
+    def flush(self):
+        """Only the target: the buffer is not written out at exit by logging.shutdown()"""
+        self.target.flush()
+
+    def dump(self):
+        """Writes out and clears the buffered records"""
+        with self.lock:
+            records, self._records = self._records, collections.deque(maxlen=self._records.maxlen)
+        if records:
+            self.target.handle(self._marker(f"--- {len(records)} buffered log record(s) ---"))
+        for record in records:
+            self.target.handle(record)
+        self.target.flush()
+
+    def formatted(self, limit=None) -> list[str]:
+        """The buffered records (the last `limit` ones), formatted, without clearing them"""
+        with self.lock:
+            records = list(self._records)
+        return [self.target.format(r) for r in records[-limit if limit else 0 :]]
+
+    @staticmethod
+    def _marker(msg) -> logging.LogRecord:
+        return logging.LogRecord("main", logging.INFO, __file__, 0, msg, None, None)
+
+
+def _level(env, name, default, errors: list) -> int:
+    if not (value := env.get(name)):
+        return default
+    if value.isdigit():
+        return int(value)
+    if isinstance(level := logging.getLevelName(value.upper()), int):
+        return level
+    errors.append(f"Unknown {name}={value!r}, using {logging.getLevelName(default)}")
+    return default
+
+
+def setup_logging(env, *, stderr_level=None) -> RingBufferHandler | None:
+    """
+    Configured from `env`:
+    TABAPPS_LOG_LEVEL, the level of the records kept (default: DEBUG);
+    TABAPPS_LOG_STDERR_LEVEL, from which records go to stderr right away (default: WARNING);
+    TABAPPS_LOG_BUFFER, how many records are kept in memory until an error (default: 2000).
+    With TABAPPS_LOG_BUFFER=0, every record is written to stderr as it comes, as a plain
+    logging setup does. Returns the ring buffer handler, if any
+    """
+    errors = []
+    level = _level(env, "TABAPPS_LOG_LEVEL", logging.DEBUG, errors)
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    capacity = int(env.get("TABAPPS_LOG_BUFFER") or 2000)
+    root = logging.getLogger()
+    root.setLevel(level)
+    if not capacity:
+        handler = None
+        root.addHandler(stderr_handler)
+    else:
+        stderr_level = _level(
+            env, "TABAPPS_LOG_STDERR_LEVEL", stderr_level or logging.WARNING, errors
+        )
+        handler = RingBufferHandler(stderr_handler, capacity, passthrough_level=stderr_level)
+        root.addHandler(handler)
+    for error in errors:
+        logging.getLogger("main").warning(error)
+    return handler
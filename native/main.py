@@ -1,78 +1,191 @@
 #!/usr/bin/env python
 
 import atexit
+import collections
 import contextlib
 import functools
-import hashlib
 import importlib
+import itertools
 import json
 import logging
 import os
-import pathlib
 import sys
-import tempfile
 import threading
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from typing import Any
-from urllib.parse import urlparse
-from urllib.request import urlopen
 
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(levelname)s %(message)s")
-logger = logging.getLogger("main")
+STARTED_AT = time.perf_counter()
+
+# --startup-report: log a timing report of the startup phases, with the `-X importtime`
+# breakdown of the imports (written by the interpreter to stderr)
+STARTUP_REPORT = "--startup-report" in sys.argv
+# --daemon: long-lived per-user companion, serving the native host shims (see shim.py)
+DAEMON = "--daemon" in sys.argv
+if STARTUP_REPORT and "importtime" not in sys._xoptions and __name__ == "__main__":
+    os.execv(sys.executable, [sys.executable, "-X", "importtime", *sys.orig_argv[1:]])
 
 sys.path.insert(0, os.path.dirname(__file__))
 
-from native_messaging import NativeMessaging
-from x11_window_control import X11WindowControl
+from log_buffer import setup_logging
 
-systray_providers = ["qt", "gtk"]
+# TABAPPS_LOG_*: see setup_logging(). The --startup-report goes to stderr right away
+log_buffer = setup_logging(os.environ, stderr_level=logging.INFO if STARTUP_REPORT else None)
+logger = logging.getLogger("main")
 
-if sp := os.environ.get("TABAPPS_SYSTRAY_PROVIDER"):
-    systray_providers = [sp]
-for sp in systray_providers:
-    with contextlib.suppress(ImportError):
-        SystrayIcon = importlib.import_module(f"systray_{sp}").SystrayIcon
-        break
-if not SystrayIcon:
-    raise Exception(f"Could not load any systray implementation. Tried: {systray_providers}")
-logging.info(f"Using systray implementation: {SystrayIcon.__module__}")
+from core_loop import CoreLoop
+from daemon import DaemonServer
+from icon_cache import IconCache, xdg_cache_dir
+from metrics import metrics, process_stats
+from native_messaging import MAX_OUTGOING_MESSAGE_SIZE, NativeMessaging
+from tray_icon_cache import DEFAULT_ICON_FILE
+from watchdog import LoopWatchdog
+from window_matcher import AppMatch, WindowMatcher, WindowRule
+from window_resolver import WindowResolver
+from x11_worker import X11Worker
 
-window_ctl = X11WindowControl()
-native_messaging = NativeMessaging()
+# The X11 and toolkit modules are heavy: they are imported once the `ready` message is out.
+SystrayIcon = None  # systray_qt.SystrayIcon | systray_gtk.SystrayIcon, see load_systray_provider()
+TRAY = None  # SystrayIcon, or a systray_aggregated.AggregatedTray of it, see load_tray()
+window_ctl = None  # x11_window_control.X11WindowControl, see start_x11()
+window_resolver: WindowResolver = None  # see start_x11()
 
+# stdio browser connection, None in daemon mode: a Session per native host shim instead
+native_messaging: NativeMessaging = None if DAEMON else NativeMessaging()
+daemon_server: DaemonServer = DaemonServer() if DAEMON else None
+core_loop = CoreLoop()
+# owns the X connection, and with it the apps: everything below runs there unless noted
+x11_worker = X11Worker()
+icon_cache = IconCache()
+# loops not running a heartbeat within TABAPPS_STALL_THRESHOLD_MS are reported, 0 disables
+watchdog = LoopWatchdog(int(os.environ.get("TABAPPS_STALL_THRESHOLD_MS") or 250) / 1000)
 
-def pthread_setname(thead: threading.Thread, name: str):
-    with contextlib.suppress(Exception):
-        import ctypes
+STARTUP_TIMINGS = {}
+
+
+def mark_startup(phase: str):
+    STARTUP_TIMINGS[phase] = time.perf_counter() - STARTED_AT
+
+
+def log_startup_report():
+    report = " ".join(f"{phase}={t * 1000:.1f}ms" for phase, t in STARTUP_TIMINGS.items())
+    logger.log(logging.INFO if STARTUP_REPORT else logging.DEBUG, f"Startup timings: {report}")
+
+
+SYSTRAY_PROVIDER_CACHE_FILE = xdg_cache_dir() / "systray-provider"
+
+
+def load_tray(systray_icon_cls):
+    """TABAPPS_SYSTRAY_MODE: `per-app` (default) tray icons, or one `aggregated` icon for all"""
+    mode = os.environ.get("TABAPPS_SYSTRAY_MODE") or "per-app"
+    if mode == "aggregated":
+        from systray_aggregated import AggregatedTray
+
+        return AggregatedTray(systray_icon_cls, icon=DEFAULT_ICON_FILE)
+    if mode != "per-app":
+        logger.warning(f"Unknown TABAPPS_SYSTRAY_MODE={mode!r}, using per-app tray icons")
+    return systray_icon_cls
+
+
+def load_systray_provider():
+    """Imports the first working systray provider, trying the last one that worked first"""
+    providers = ["qt", "gtk"]
+    cached = None
+    if sp := os.environ.get("TABAPPS_SYSTRAY_PROVIDER"):
+        providers = [sp]
+    else:
+        with contextlib.suppress(OSError):
+            cached = SYSTRAY_PROVIDER_CACHE_FILE.read_text().strip()
+        if cached in providers:
+            providers.remove(cached)
+            providers.insert(0, cached)
+    for sp in providers:
+        try:
+            systray_icon_cls = importlib.import_module(f"systray_{sp}").SystrayIcon
+        except ImportError as e:
+            logger.debug(f"Systray implementation {sp} is not usable: {e!r}")
+            continue
+        if sp != cached:
+            with contextlib.suppress(OSError):
+                SYSTRAY_PROVIDER_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+                SYSTRAY_PROVIDER_CACHE_FILE.write_text(sp)
+        logging.info(f"Using systray implementation: {systray_icon_cls.__module__}")
+        return systray_icon_cls
+    raise Exception(f"Could not load any systray implementation. Tried: {providers}")
+
+
+@functools.cache
+def _pthread_setname_np():
+    import ctypes
+
+    try:
+        # part of libc itself since glibc 2.34, saves the find_library() subprocesses
+        pthread_setname_np = ctypes.CDLL(None).pthread_setname_np
+    except AttributeError:
         import ctypes.util
 
         pthread_setname_np = ctypes.CDLL(ctypes.util.find_library("pthread")).pthread_setname_np
-        pthread_setname_np.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
-        pthread_setname_np.restype = ctypes.c_int
-        pthread_setname_np(thead.ident, name.encode()[:15])
+    pthread_setname_np.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    pthread_setname_np.restype = ctypes.c_int
+    return pthread_setname_np
+
+
+def pthread_setname(thead: threading.Thread, name: str):
+    with contextlib.suppress(Exception):
+        _pthread_setname_np()(thead.ident, name.encode()[:15])
 
 
 @dataclass
 class AppState:
-    id: str
+    id: str  # in the namespace of its session
+    session: "Session" = field(default=None, repr=False)
     label: str = ""
     window: Any = None
     icon_file: str = None
-    systray_icon: SystrayIcon = None
-
-    def dispose(self):
-        if self.systray_icon:
-            self.systray_icon.dispose()
+    icon_url: str = None
+    config: dict = None  # as last received, to skip unchanged apps
+    systray_icon: "SystrayIcon" = None
+
+    def dispose(self, destroy=False, release_window=False):
+        """
+        Forgets the window. The tray icon is parked for a relaunch, unless `destroy`. With
+        `release_window` or `destroy`, the window, if still open, is given back to the taskbar,
+        as the tray icon was the way back to it
+        """
+        if self.window:
+            window_ctl.window_states.untrack(self.window.id)
+            if destroy or release_window:
+                window_ctl.release_window(self.window)
+        if destroy:
+            TRAY.discard(self.tray_id)
+        elif self.systray_icon:
+            self.systray_icon.release()
         self.window = None
         self.systray_icon = None
 
+    @property
+    def key(self) -> tuple[int, str]:
+        """Unique across the sessions"""
+        return self.session.id, self.id
+
+    @property
+    def tray_id(self) -> str:
+        return f"{self.session.id}:{self.id}"
+
+    def set_window_state(self, state):
+        if self.systray_icon:
+            self.systray_icon.set_state(state)
+
     def add_to_systray(self):
         def _callbackify(fn):
             @functools.wraps(fn)
             def _wrapped(*args):
-                logger.debug(f"[{self.id}] callback {fn.__name__} : {args}")
-                fn(self)
+                logger.debug("[%s] callback %s", self.id, fn.__name__)
+                # tray callbacks come from the UI thread, which never waits on the X11 worker
+                if x11_worker.in_worker_thread():
+                    fn(self)
+                else:
+                    x11_worker.submit(fn, self)
 
             return _wrapped
 
@@ -86,14 +199,23 @@ class AppState:
 
         @_callbackify
         def handle_exit(app):
+            # disposed once the window is destroyed, see on_window_state_changed(): the browser
+            # may still cancel the close (beforeunload)
             window_ctl.close_app_window(app.window)
-            app.dispose()
 
         @_callbackify
         def handle_dump(app):
+            if log_buffer:
+                log_buffer.dump()
             print(f"\n{app=}", file=sys.stderr, flush=True)
             window_ctl.dump(app.window)
 
+        @_callbackify
+        def handle_stats(app):
+            stats = collect_stats()
+            print(f"\nstats={json.dumps(stats, indent=2)}", file=sys.stderr, flush=True)
+            app.systray_icon.show_message("Tab Apps companion stats", format_stats_summary(stats))
+
         @_callbackify
         def toggle_window_visibilty(app):
             if window_ctl.is_app_window_minimized(app.window):
@@ -105,11 +227,12 @@ class AppState:
             (f"Show {self.label}", handle_show_app),
             (f"Minimize", handle_hide_app),
             ("Dump", handle_dump),
+            ("Stats", handle_stats),
             "SEPARATOR",
             ("Exit", handle_exit),
         ]
-        tray_icon = SystrayIcon(
-            id=self.id,
+        tray_icon = TRAY.acquire(
+            id=self.tray_id,
             icon=self.icon_file,
             title=self.label or self.id,
             menu_items=menu_items,
@@ -118,141 +241,673 @@ class AppState:
         self.systray_icon = tray_icon
 
 
-DEFAULT_ICON_FILE = os.path.join(os.path.dirname(__file__), "icon.png")
+@dataclass
+class Session:
+    """
+    One extension instance (browser profile) served by the companion, with its own namespace
+    of app ids. All the sessions share the X connection, the window index and the tray
+    """
+
+    id: int
+    native_messaging: NativeMessaging = None  # None while disconnected (daemon mode)
+    instance_id: str = None  # extensionInstanceId, from its config
+    apps: dict[str, AppState] = field(default_factory=dict)
+
+    def post(self, message):
+        """From any thread, to the current connection of the session if any"""
+        if nm := self.native_messaging:
+            post(nm, message)
+        else:
+            logger.debug(
+                "[session=%d] Disconnected, dropping a %s message", self.id, message["type"]
+            )
+
+    def has_windows(self) -> bool:
+        return any(app.window for app in self.apps.values())
 
-APPS = {}
 
+SESSIONS: dict[int, Session] = {}
+CONNECTIONS: dict[NativeMessaging, Session] = {}  # open connection => its session
+_session_ids = itertools.count(1)
 
-def remove_temp_icon_files():
-    if os.environ.get("TABAPPS_KEEP_TEMP_ICON_FILES") == "true":
-        return
-    for app in APPS.values():
-        if app.icon_file and app.icon_file != DEFAULT_ICON_FILE and os.path.exists(app.icon_file):
-            logger.info(f"Removing temp icon file: {app.icon_file}")
-            os.unlink(app.icon_file)
 
+def all_apps():
+    return (app for session in SESSIONS.values() for app in session.apps.values())
 
-atexit.register(remove_temp_icon_files)
+
+def window_owner(w) -> AppState | None:
+    return next((app for app in all_apps() if app.window == w), None)
+
+
+def open_session(nm: NativeMessaging):
+    """A browser connected: a new session, until its config tells which instance it is"""
+    session = Session(next(_session_ids), nm)
+    SESSIONS[session.id] = CONNECTIONS[nm] = session
+    logger.info("[session=%d] Opened, %d session(s)", session.id, len(SESSIONS))
+
+
+def claim_instance(session: Session, instance_id: str):
+    """
+    Once the config tells the extension instance of a connection: if that instance had a
+    session that is disconnected (it reconnects to the daemon), the session of the connection
+    takes it over, with its id, apps, windows and tray icons. A session whose connection is
+    still open is never taken over
+    """
+    if session.instance_id == instance_id:
+        return
+    session.instance_id = instance_id
+    others = [s for s in SESSIONS.values() if s is not session and s.instance_id == instance_id]
+    if not (previous := next((s for s in others if not s.native_messaging), None)):
+        if others:
+            logger.warning(
+                "[session=%d] Instance %s is already connected as session %d, kept apart",
+                session.id,
+                instance_id,
+                others[0].id,
+            )
+        return
+    logger.info("[session=%d] Resumed by a new connection of %s", previous.id, instance_id)
+    close_session(session)  # the apps it got before its config, if any
+    session.id, session.apps = previous.id, previous.apps
+    for app in session.apps.values():
+        app.session = session
+    SESSIONS[session.id] = session
+
+
+def close_connection(nm: NativeMessaging):
+    """
+    A browser disconnected. Its session is kept, for the instance to reconnect (daemon mode),
+    as long as it manages windows
+    """
+    if not (session := CONNECTIONS.pop(nm, None)) or session.native_messaging is not nm:
+        return
+    session.native_messaging = None
+    if not session.has_windows():
+        close_session(session)
+
+
+def close_session(session: Session):
+    SESSIONS.pop(session.id, None)
+    apps = list(session.apps.values())
+    session.apps.clear()
+    for app in apps:
+        window_resolver.cancel(app.key)
+        app.dispose(destroy=True)
+        release_icon_file(app.icon_file)
+    logger.info("[session=%d] Closed, %d session(s) left", session.id, len(SESSIONS))
+
+
+def resolve_app_windows(launch_messages) -> dict[str, AppMatch]:
+    """Matches the windows of all the app-launch messages in one pass"""
+    matcher = WindowMatcher()
+    for msg in launch_messages:
+        matcher.add(msg["appId"], WindowRule.from_message(msg))
+    matches = window_ctl.match_app_windows(matcher) if matcher else {}
+    for m in matches.values():
+        if m.ambiguous:
+            logger.warning(
+                f"[app_id={m.app_id}] Ambiguous window match, using the first one: {m.window=}"
+                f" candidates={[w.id for w in m.candidates]} shared_with={sorted(m.shared_with)}"
+            )
+    return matches
 
 
-def do_refresh_app(app_id, title_fingerprint):
-    logger.debug(f"[{app_id=}] do_refresh_app() called")
-    if not (app := APPS.get(app_id)):
-        logger.warning(f"[{app_id=}] do_refresh_app() missing app config for {app_id=}")
+def do_refresh_app(session: Session, app_id, match: AppMatch | None) -> dict | None:
+    logger.debug("[app_id=%r] do_refresh_app() called", app_id)
+    if not (app := session.apps.get(app_id)):
+        logger.warning("[app_id=%r] do_refresh_app() missing app config", app_id)
         return
-    w = window_ctl.find_app_window(title_fingerprint)
-    if not w:
-        logger.debug(f"[{app_id=}] No app window found for {title_fingerprint=} {app=}")
+    if not match:
+        logger.debug("[app_id=%r] No app window found", app_id)
         app.dispose()
         return
+    w = match.window
+    if (owner := window_owner(w)) and owner.session is not session:
+        logger.warning(
+            "[app_id=%r] Window %r is already managed by session %d", app_id, w, owner.session.id
+        )
+        app.dispose()
+        return {"type": "window-state", "appId": app_id, "nativeWindowId": None, "state": "claimed"}
     try:
         if app.window:
             if app.window == w:
-                logger.debug(f"[{app_id=}] Nothing to do. App window unchanged:")
-                return
+                logger.debug("[app_id=%r] Nothing to do. App window unchanged", app_id)
+                # still replied to: a browser reconnecting to the daemon does not know the window
+                return managed_reply(app_id, match, window_ctl.window_states.states.get(w.id))
             logger.warning(
                 f"[{app_id=}] App window changed without noticing: {app.window=} => {w=}"
             )
+            window_ctl.window_states.untrack(app.window.id)
         else:
-            logger.debug(f"[{app_id=}] New app window found: {w=} {w.title=}")
+            logger.debug("[app_id=%r] New app window found: 0x%x w.title=%r", app_id, w.id, w.title)
         window_ctl.init_window(w)
         app.window = w
+        window_state = window_ctl.window_states.track(w)
         app.add_to_systray()
+        app.set_window_state(window_state)
     except Exception:
         logger.exception("Error while init_window()")
         with contextlib.suppress(Exception):
             app.dispose()
     else:
-        native_messaging.post(
-            {"type": "window-state", "appId": app_id, "nativeWindowId": w.id, "state": "managed"}
-        )
+        return managed_reply(app_id, match, window_state)
+
+
+def managed_reply(app_id, match: AppMatch, window_state) -> dict:
+    reply = {
+        "type": "window-state",
+        "appId": app_id,
+        "nativeWindowId": match.window.id,
+        "state": "managed",
+        "windowState": window_state,
+    }
+    if match.ambiguous:
+        reply["candidates"] = [c.id for c in match.candidates]
+        reply["sharedWith"] = sorted(match.shared_with)
+    return reply
+
+
+def on_window_state_changed(w, state):
+    """
+    Pushes the state changes of the managed windows, whoever made them (tray, extension, or
+    the user through the window manager): hidden, visible, focused or closed. Title changes too
+    """
+    if not (app := window_owner(w)):
+        return
+    logger.debug("[app_id=%r] Window state: %s w.title=%r", app.id, state, w.title)
+    app.session.post(
+        {
+            "type": "window-state",
+            "appId": app.id,
+            "nativeWindowId": w.id,
+            "state": state,
+            "title": w.title,
+        }
+    )
+    if state == "closed":
+        app.dispose()
+        if not app.session.native_messaging and not app.session.has_windows():
+            close_session(app.session)  # not coming back, as far as the windows go
+    else:
+        app.set_window_state(state)
 
 
-def do_window_action(app_id, action):
-    logger.debug(f"[{app_id=}] do_window_action() called")
-    if not (app := APPS.get(app_id)):
-        logger.warning(f"[{app_id=}] do_window_action() missing app config for {app_id=}")
-        return
-    if not app.window:
-        logger.warning(f"[{app_id=}] do_window_action() missing window for {app_id=}")
+def on_app_window_resolved(key: tuple[int, str], match: AppMatch | None):
+    """Deferred outcome of an app-launch whose window was not found right away"""
+    session_id, app_id = key
+    if not (session := SESSIONS.get(session_id)):
         return
-    if action == "iconify":
-        window_ctl.minimize_app_window(app.window)
-    if action == "restore":
-        window_ctl.restore_app_window(app.window)
-    if action == "dump":
-        window_ctl.dump(app.window)
+    if match:
+        # the resolver matches the pending apps of all the sessions at once, by key: sharedWith
+        # only names the apps of the same session, by id
+        shared_with = {
+            other_id
+            for other_session_id, other_id in match.shared_with
+            if other_session_id == session_id
+        }
+        match = replace(match, app_id=app_id, shared_with=shared_with)
+        reply = do_refresh_app(session, app_id, match)
+    else:
+        if app := session.apps.get(app_id):
+            app.dispose()
+        reply = {
+            "type": "window-state",
+            "appId": app_id,
+            "nativeWindowId": None,
+            "state": "not-found",
+        }
+    if reply:
+        session.post(reply)
+
+
+def do_window_actions(session: Session, app_ids: list[str] | str, action) -> list[dict]:
+    """
+    Applies `action` to the windows of the session's `app_ids` ("all": every app with a window)
+    as one group, sent to the X server with a single flush. Returns the result of each action
+    """
+    from x11_window_control import WINDOW_ACTIONS
+
+    if app_ids == "all":
+        app_ids = [app_id for app_id, app in session.apps.items() if app.window]
+    logger.debug("do_window_actions() called: action=%r, %d app(s)", action, len(app_ids))
+    results = []
+    grouped = []  # (result, window) of the actions sent to the X server
+    for app_id in app_ids:
+        result = {"appId": app_id, "ok": False}
+        results.append(result)
+        if not (app := session.apps.get(app_id)):
+            logger.warning("[app_id=%r] do_window_actions() missing app config", app_id)
+            result["error"] = "unknown-app"
+        elif not app.window:
+            logger.warning("[app_id=%r] do_window_actions() missing window", app_id)
+            result["error"] = "no-window"
+        elif action == "dump":
+            window_ctl.dump(app.window)
+            result["ok"] = True
+        elif action not in WINDOW_ACTIONS:
+            result["error"] = "unknown-action"
+        else:
+            grouped.append((result, app.window))
+    errors = window_ctl.apply_window_actions([(w, action) for _, w in grouped])
+    for (result, _), error in zip(grouped, errors):
+        if error:
+            logger.warning("[%s] Window action %s failed: %s", result["appId"], action, error)
+            result["error"] = error
+        result["ok"] = not error
+    return results
+
+
+def release_icon_file(icon_file):
+    """Drops the decoded tray icon of `icon_file` once no app uses it anymore"""
+    if icon_file and icon_file != DEFAULT_ICON_FILE:
+        if not any(app.icon_file == icon_file for app in all_apps()):
+            SystrayIcon.evict_icon(icon_file)
+            icon_cache.unpin(icon_file)
+
+
+def fetch_app_icon(app: AppState, url):
+    """Fetches the icon in the background, the app keeps its current icon until it arrives"""
+
+    def _on_fetched(icon_file, error):
+        if error:
+            logger.warning(f"[app_id={app.id!r}] Could not fetch icon from {url}: {error!r}")
+            return
+        x11_worker.submit(_set_icon, str(icon_file))
+
+    def _set_icon(icon_file):
+        removed = app.session.apps.get(app.id) is not app
+        if removed or app.icon_url != url or app.icon_file == icon_file:
+            return
+        set_app_icon_file(app, icon_file)
+
+    if cached := icon_cache.get_cached(url):
+        _set_icon(str(cached))
+    icon_cache.fetch_async(url, _on_fetched)
+
+
+def set_app_icon_file(app: AppState, icon_file):
+    old_icon_file, app.icon_file = app.icon_file, icon_file
+    if icon_file != DEFAULT_ICON_FILE:
+        icon_cache.pin(icon_file)
+    if app.systray_icon:
+        app.systray_icon.set_icon(icon_file)
+    release_icon_file(old_icon_file)
+
+
+def apply_config(session: Session, apps_cfg: list[dict]):
+    """
+    Brings the apps of the session in line with the config: only added, changed and removed
+    apps are touched
+    """
+    apps = session.apps
+    new_ids = {cfg["id"] for cfg in apps_cfg}
+    for app_id in apps.keys() - new_ids:
+        app = apps.pop(app_id)
+        logger.info(f"[{app_id=}] App was removed from the config: disposing {app=}")
+        window_resolver.cancel(app.key)
+        app.dispose(destroy=True)
+        release_icon_file(app.icon_file)
+    for cfg in apps_cfg:
+        app_id: str = cfg["id"]
+        app = apps.get(app_id)
+        if app and app.config == cfg:
+            continue
+        label = cfg.get("label") or app_id.capitalize()
+        icon_url = cfg.get("icon")
+        if not app:
+            app = apps[app_id] = AppState(
+                id=app_id, session=session, label=label, icon_file=DEFAULT_ICON_FILE
+            )
+        else:
+            changed = ", ".join(
+                k for k in cfg.keys() | app.config.keys() if cfg.get(k) != app.config.get(k)
+            )
+            logger.debug("[app_id=%r] App config changed: %s", app_id, changed)
+            if app.label != label:
+                app.label = label
+                if app.systray_icon:
+                    app.add_to_systray()  # rebound: the title and the "Show <label>" item
+        app.config = cfg
+        if app.icon_url != icon_url:
+            app.icon_url = icon_url
+            if icon_url:
+                fetch_app_icon(app, icon_url)
+            elif app.icon_file != DEFAULT_ICON_FILE:
+                set_app_icon_file(app, DEFAULT_ICON_FILE)
+
+
+def collect_stats() -> dict:
+    """Runtime metrics of the companion. Must be called from the X11 worker"""
+    from x11_window_control import round_trips
+
+    return {
+        "uptime_s": round(time.perf_counter() - STARTED_AT, 3),
+        "apps": sum(1 for _ in all_apps()),
+        "sessions": [
+            {
+                "id": s.id,
+                "instance_id": s.instance_id,
+                "connected": bool(s.native_messaging),
+                "apps": len(s.apps),
+            }
+            for s in SESSIONS.values()
+        ],
+        **metrics.snapshot(),
+        "x11": round_trips.as_dict(),
+        "x11_worker": dict(x11_worker.stats),
+        "tray_icon_cache": SystrayIcon.icon_cache_stats(),
+        "icon_cache": dict(icon_cache.stats),
+        "native_messaging": native_messaging_stats(),
+        "daemon": {"connections": daemon_server.connections} if daemon_server else None,
+        "process": process_stats(),
+        "stalls": watchdog.last_stalls,
+    }
+
+
+def native_messaging_stats() -> dict:
+    """Totals of all the connections, except for max_queue_depth: the largest one"""
+    connections = list(CONNECTIONS)
+    stats = sum((collections.Counter(nm.stats) for nm in connections), collections.Counter())
+    stats["max_queue_depth"] = max((nm.stats["max_queue_depth"] for nm in connections), default=0)
+    stats["queue_depth"] = sum(nm.queue_depth for nm in connections)
+    return dict(stats)
+
+
+def format_stats_summary(stats) -> str:
+    messages = sum(n for name, n in stats["counters"].items() if name.startswith("messages."))
+    dispatch_max = max((h["max_ms"] for h in stats["histograms"].values()), default=0)
+    process = stats["process"]
+    return "\n".join(
+        [
+            f"Uptime: {stats['uptime_s']:.0f}s, apps: {stats['apps']},"
+            f" sessions: {len(stats['sessions'])}",
+            f"Messages: {messages}, slowest dispatch: {dispatch_max:.1f}ms",
+            f"X11 round trips: {sum(op['round_trips'] for op in stats['x11'].values())}",
+            f"Tray icon cache: {stats['tray_icon_cache']}",
+            f"Outbound queue: {stats['native_messaging']['queue_depth']}",
+            f"RSS: {process.get('rss_kb', 0) // 1024} MB, open fds: {process.get('open_fds')}",
+        ]
+    )
+
+
+def handle_native_message(session: Session, msg, resolved: dict[str, AppMatch] = None):
+    """
+    Handles one message of `session` and returns the replies to it.
+    `resolved` holds the app windows already matched for the app-launch messages of a batch
+    """
+    type = msg["type"]
+    metrics.inc(f"messages.{type}")
+    with metrics.timer(f"dispatch.{type}"):
+        return _dispatch_native_message(session, type, msg, resolved)
+
+
+def _dispatch_native_message(session: Session, type, msg, resolved) -> list[dict]:
+    replies = []
+    if type == "ping":
+        replies.append({"type": "pong"})
+    if type == "heartbeat":  # liveness: unlike ping, answered before the pending messages
+        replies.append({"type": "heartbeat"})
+    if type == "batch":
+        # sub-messages are handled in order, as one unit with one combined reply
+        sub_replies = []
+        with window_ctl.snapshot():
+            launches = [m for m in msg["messages"] if m.get("type") == "app-launch"]
+            resolved = resolve_app_windows(launches) if len(launches) > 1 else None
+            for index, sub_msg in enumerate(msg["messages"]):
+                try:
+                    sub_replies.extend(handle_native_message(session, sub_msg, resolved))
+                except Exception as e:
+                    logger.exception(f"Error while processing batched message #{index}")
+                    sub_replies.append({"type": "error", "index": index, "error": repr(e)})
+        replies.append({"type": "batch", "messages": sub_replies})
+    if type == "config":
+        if instance_id := msg.get("extensionInstanceId"):
+            claim_instance(session, instance_id)
+        apply_config(session, msg["apps"])
+    if type == "app-launch":
+        app_id: str = msg["appId"]
+        if resolved is None:
+            resolved = resolve_app_windows([msg])
+        if not (match := resolved.get(app_id)) and app_id in session.apps:
+            # the window may not be mapped or titled yet: see on_app_window_resolved()
+            window_resolver.add((session.id, app_id), WindowRule.from_message(msg))
+        else:
+            window_resolver.cancel((session.id, app_id))
+            if reply := do_refresh_app(session, app_id, match):
+                replies.append(reply)
+    if type == "app-close":
+        app_id: str = msg["appId"]
+        app = session.apps.get(app_id)
+        logger.info("[app_id=%r] App was closed: disposing it", app_id)
+        window_resolver.cancel((session.id, app_id))
+        if app:
+            # the window may stay open: unlaunched, or dropped before its app is removed from
+            # the config (which then finds no window left to release)
+            app.dispose(release_window=True)
+    if type == "window-action":
+        # targets: "appIds", a list of app ids or "all", or a single "appId"
+        action = msg["action"]
+        app_ids = msg["appIds"] if "appIds" in msg else [msg["appId"]]
+        results = do_window_actions(session, app_ids, action)
+        replies.append({"type": "window-action-result", "action": action, "results": results})
+    if type == "stats":
+        replies.append({"type": "stats", "stats": collect_stats()})
+    if type == "logs":
+        # the last `limit` buffered records, which are also written out to stderr
+        records = log_buffer.formatted(msg.get("limit") or 200) if log_buffer else []
+        if log_buffer:
+            log_buffer.dump()
+        records = fit_log_records(records)
+        replies.append({"type": "logs", "records": records})
+    return replies
+
+
+def fit_log_records(records: list[str]) -> list[str]:
+    """The most recent of `records` that fit in one native message"""
+    budget = MAX_OUTGOING_MESSAGE_SIZE - 1024  # the rest of the reply, with margin
+    for index in range(len(records) - 1, -1, -1):
+        budget -= len(json.dumps(records[index])) + 1
+        if budget < 0:
+            return records[index + 1 :]
+    return records
+
+
+def handle_connection_message(nm: NativeMessaging, msg) -> list[dict]:
+    """On the X11 worker: `msg` is handled by the session of the connection it came from"""
+    if not (session := CONNECTIONS.get(nm)):
+        return []  # closed meanwhile, see close_connection()
+    return handle_native_message(session, msg)
+
+
+EXIT_CODE = 0
+
+
+def shutdown(exit_code: int):
+    global EXIT_CODE
+    EXIT_CODE = exit_code
+    loop = SystrayIcon.get_loop()
+    SystrayIcon.call_in_ui(loop.quit)
+
+
+def post(nm: NativeMessaging, message):
+    """Posts to a browser from any thread: the outbound queues belong to the core loop"""
+    core_loop.call_soon_threadsafe(nm.post, message)
+
+
+def post_ready(nm: NativeMessaging):
+    nm.post(
+        {
+            "type": "ready",
+            "pid": os.getpid(),
+            "cwd": os.getcwd(),
+            "args": sys.orig_argv,
+            "daemon": DAEMON,
+        }
+    )
+
+
+def listen(nm: NativeMessaging):
+    """A browser connected: its messages go to a session of its own"""
+    x11_worker.submit(open_session, nm)
+    nm.register_listener(functools.partial(on_native_message, nm), core_loop)
+
+
+def on_shim_connected(conn):
+    """Daemon mode: one more browser connected, through a native host shim"""
+    logger.info("Browser connected (#%d)", daemon_server.connections)
+    nm = NativeMessaging(in_stream=conn, out_stream=conn)
+    listen(nm)
+    post_ready(nm)
 
 
-def get_icon_file_from_url(app_id, url):
-    h = hashlib.md5(url.encode()).hexdigest()
-    ext = pathlib.PurePosixPath(urlparse(url).path).suffix
-    fname = pathlib.Path(tempfile.gettempdir(), "tabapps-" + app_id + "-" + h + ext)
-    # if fname.exists():
-    #     return fname
-    logger.info(f"[{app_id=}] Downloading icon from {url} to {fname}")
+def disconnect(nm: NativeMessaging):
+    """
+    Daemon mode: stops reading, and closes the connection once the replies to the messages
+    already handed over to the X11 worker are out. The session is kept for the instance to
+    reconnect, see close_connection()
+    """
+    nm.stop_reading()
+    # replies are posted to the core loop as each command completes, so before _close()
+    future = x11_worker.submit(close_connection, nm)
+    future.add_done_callback(lambda _: core_loop.call_soon_threadsafe(_close, nm))
 
-    with contextlib.closing(urlopen(url, timeout=5)) as resp, open(fname, "wb") as f:
-        if int(resp.info().get("Content-Length")) > 500 * 1024:  # 500KB
-            raise Exception(f"Icon file too large: {resp.info().get('Content-Length')}")
-        while chunk := resp.read(8 * 1024):
-            f.write(chunk)
 
-    return fname
+def _close(nm: NativeMessaging):
+    nm.detach()
+    nm.in_stream.close()
 
 
-def on_native_message(msg):
+def on_native_message(nm: NativeMessaging, msg):
+    """Runs on the core loop, which hands the messages over to the X11 worker, in order"""
+    if not nm.reading:  # the rest of a read after a disconnect()
+        return
     if msg is None:  # EOF
         logger.info("EOF while reading native message")
-        sys.exit(0)
+        return disconnect(nm) if DAEMON else shutdown(0)
     if isinstance(msg, Exception):
         logger.error("Error while reading native message", exc_info=msg)
-        sys.exit(2)
+        metrics.inc("errors.read")
+        return disconnect(nm) if DAEMON else shutdown(2)
     try:
-        logging.debug("Received native message: %s", msg)
-        type = msg["type"]
-        if type == "ping":
-            native_messaging.post({"type": "pong"})
-        if type == "config":
-            for cfg in msg["apps"]:
-                app_id: str = cfg["id"]
-                if not (app := APPS.get(app_id)):
-                    icon_file = DEFAULT_ICON_FILE
-                    if icon_url := cfg.get("icon"):
-                        with contextlib.suppress(Exception):
-                            icon_file = get_icon_file_from_url(app_id, icon_url)
-                    APPS[app_id] = AppState(
-                        id=app_id,
-                        label=cfg.get("label") or app_id.capitalize(),
-                        icon_file=icon_file,
-                    )
-        if type == "app-launch":
-            app_id: str = msg["appId"]
-            window_title_fingerprint = msg["windowTitleFingerprint"]
-            do_refresh_app(app_id, window_title_fingerprint)
-        if type == "app-close":
-            app_id: str = msg["appId"]
-            app = APPS.get(app_id)
-            logger.info(f"[{app_id=}] App was closed: disposing {app=}")
-            if app:
-                app.dispose()
-        if type == "window-action":
-            app_id: str = msg["appId"]
-            action = msg["action"]
-            do_window_action(app_id, action)
+        logger.debug("Received native message: %s", msg["type"])
+        # no X11: answered even while the worker is busy. ping is not, so that its pong comes
+        # after the replies to everything sent before it
+        if msg["type"] in ("heartbeat", "logs"):
+            for reply in handle_native_message(None, msg):
+                nm.post(reply)
+            return
+        if msg["type"] == "stats":  # read-only: requests made while one is pending share it
+            future = x11_worker.query("stats", handle_native_message, None, msg)
+        else:
+            future = x11_worker.submit(handle_connection_message, nm, msg)
+        future.add_done_callback(functools.partial(_on_native_message_handled, nm))
     except Exception:
         logger.exception("Error while processing native message")
+        metrics.inc("errors.dispatch")
 
 
-def main():
-    loop = SystrayIcon.get_loop()
-
-    native_messaging.register_listener(on_native_message, loop.register_io_watch)
-    native_messaging.post(
-        {"type": "ready", "pid": os.getpid(), "cwd": os.getcwd(), "args": sys.orig_argv}
+def _on_native_message_handled(nm: NativeMessaging, future):
+    if future.exception():  # already logged by the worker
+        metrics.inc("errors.dispatch")
+        return
+    for reply in future.result():
+        post(nm, reply)
+
+
+def start_core():
+    """First thing on the core loop, while the UI thread is loading the systray provider"""
+    if not DAEMON:  # else once a browser connects
+        post_ready(native_messaging)
+        mark_startup("ready_posted")
+    x11_worker.start()
+    x11_worker.submit(start_x11)
+    pthread_setname(core_loop.thread, core_loop.thread.name)
+
+
+def start_x11():
+    """First thing on the X11 worker: anything submitted later finds the X server connected"""
+    global window_ctl, window_resolver
+    x11_worker.on_connection_lost = on_x11_connection_lost
+    window_ctl = x11_worker.open()
+    window_resolver = WindowResolver(
+        x11_worker.loop,
+        match_pending_app_windows,
+        on_app_window_resolved,
+        # how long app-launch waits for the window to show up
+        timeout=int(os.environ.get("TABAPPS_WINDOW_RESOLVE_TIMEOUT_MS") or 10000) / 1000,
     )
+    window_ctl.window_index.change_listeners.append(window_resolver.windows_changed)
+    window_ctl.window_states.listeners.append(on_window_state_changed)
+    mark_startup("x11_ready")
+    pthread_setname(x11_worker.thread, x11_worker.thread.name)
+
+
+def on_x11_connection_lost():
+    """
+    The X server is gone (the session ended), and the windows with it. The companion exits
+    rather than keep serving with a dead display: in daemon mode, that frees the socket and
+    its lock for the daemon of the next session
+    """
+    shutdown(3)
+
+
+def match_pending_app_windows(matcher: WindowMatcher) -> dict[str, AppMatch]:
+    """For the WindowResolver retries, which run on the X11 worker loop but outside of a drain"""
+    try:
+        return window_ctl.match_app_windows(matcher)
+    finally:  # the events read while waiting on replies, see X11Worker._drain()
+        x11_worker.loop.call_soon(x11_worker.process_events)
+
+
+def start_dispatch():
+    """
+    Once the systray provider is up. The messages are queued on the X11 worker behind
+    start_x11(), so they are handled once the X server is connected too
+    """
+    if DAEMON:
+        daemon_server.serve(core_loop, on_shim_connected)
+    else:
+        listen(native_messaging)
+    mark_startup("dispatch_started")
+
+
+def main():
+    global SystrayIcon, TRAY
+    mark_startup("imports_done")
+    if DAEMON and not daemon_server.bind():
+        logger.info("The companion daemon is already running on %s", daemon_server.path)
+        sys.exit(0)
+    core_loop.start()
+    core_loop.call_soon_threadsafe(start_core)
+    atexit.register(lambda: native_messaging and native_messaging.close())
 
-    loop.run()
+    SystrayIcon = load_systray_provider()
+    TRAY = load_tray(SystrayIcon)
+    loop = SystrayIcon.get_loop()
+    mark_startup("systray_loaded")
+    core_loop.call_soon_threadsafe(start_dispatch)
+
+    def _on_ui_loop_running():
+        mark_startup("ui_loop_running")
+        # after start_dispatch() and start_x11()
+        core_loop.call_soon_threadsafe(x11_worker.submit, log_startup_report)
+        if watchdog.threshold > 0:
+            watchdog.watch("ui", SystrayIcon.call_in_ui, threading.main_thread())
+            watchdog.watch("core", core_loop.call_soon_threadsafe, core_loop.thread)
+            watchdog.watch("x11", x11_worker.loop.call_soon_threadsafe, x11_worker.thread)
+            watchdog.start()
+
+    loop.call_soon(_on_ui_loop_running)
+
+    loop.run()  # the UI loop, until shutdown()
+
+    watchdog.stop()
+    x11_worker.stop()
+    core_loop.stop()
+    if daemon_server:
+        daemon_server.close()
+    icon_cache.shutdown()
+    sys.exit(EXIT_CODE)
 
 
 if __name__ == "__main__":
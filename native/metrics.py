@@ -0,0 +1,102 @@
+import bisect
+import collections
+import contextlib
+import os
+import resource
+import threading
+import time
+
+# upper bounds of the histogram buckets, in milliseconds (the last bucket is unbounded)
+HISTOGRAM_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets: cheap to update, percentiles are bucket bounds"""
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q) -> float:
+        """Upper bound of the bucket holding the q-th percentile (max_ms for the last bucket)"""
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max_ms
+        return 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p99_ms": self.percentile(99),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": {
+                f"le_{b}ms" if i < len(self.buckets) else "inf": n
+                for i, (b, n) in enumerate(zip((*self.buckets, None), self.counts))
+                if n
+            },
+        }
+
+
+class Metrics:
+    """Process-wide counters and latency histograms. Thread-safe"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.histograms: dict[str, Histogram] = {}
+
+    def inc(self, name: str, count=1):
+        with self._lock:
+            self.counters[name] += count
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            if not (histogram := self.histograms.get(name)):
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {name: h.as_dict() for name, h in self.histograms.items()},
+            }
+
+
+def process_stats() -> dict:
+    stats = {
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "threads": threading.active_count(),
+    }
+    with contextlib.suppress(OSError):
+        with open("/proc/self/statm") as f:
+            stats["rss_kb"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    with contextlib.suppress(OSError):
+        stats["open_fds"] = len(os.listdir("/proc/self/fd"))
+    return stats
+
+
+metrics = Metrics()
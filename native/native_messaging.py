@@ -1,59 +1,251 @@
+import collections
+import contextlib
+import itertools
 import json
 import logging
 import os
+import select
 import struct
 import sys
-from functools import partial
-from typing import BinaryIO
 
 logger = logging.getLogger(__name__)
 
+# https://developer.chrome.com/docs/extensions/develop/concepts/native-messaging#native-messaging-host-protocol
+MAX_INCOMING_MESSAGE_SIZE = 4 * 1024 * 1024 * 1024 - 1  # 4 GB, from the browser to the host
+MAX_OUTGOING_MESSAGE_SIZE = 1024 * 1024  # 1 MB, from the host to the browser
+
+HEADER = struct.Struct("@I")
+
+IOV_MAX = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 1024
+
+
+class FrameDecoder:
+    """
+    Incremental decoder of length-prefixed frames over a reusable buffer.
+
+    Reads land directly in the buffer (no intermediate bytes objects), split frames are put
+    back together, and payloads are handed out as memoryview slices of the buffer, valid until
+    the next fill().
+    """
+
+    def __init__(self, max_size=MAX_INCOMING_MESSAGE_SIZE, initial_capacity=64 * 1024):
+        self.max_size = max_size
+        self._buf = bytearray(initial_capacity)
+        self._start = 0  # first byte not consumed yet
+        self._end = 0  # end of the received data
+
+    def _reserve(self, size):
+        """Makes room for `size` more bytes after the received data"""
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if self._start:  # compact: move the unconsumed bytes to the front
+            self._buf[:pending] = self._buf[self._start : self._end]
+            self._start, self._end = 0, pending
+        if len(self._buf) - self._end < size:
+            self._buf.extend(bytes(pending + size - len(self._buf)))
+
+    def fill(self, fd) -> bool:
+        """Reads everything available on the non-blocking `fd`. Returns False once EOF is reached"""
+        while True:
+            self._reserve(self._wanted())
+            with memoryview(self._buf) as view:
+                try:
+                    n = os.readv(fd, [view[self._end :]])
+                except BlockingIOError:
+                    return True
+            if n == 0:
+                return False
+            self._end += n
+
+    def _wanted(self):
+        pending = self._end - self._start
+        if pending >= HEADER.size:
+            (msg_len,) = HEADER.unpack_from(self._buf, self._start)
+            if msg_len <= self.max_size:
+                return max(HEADER.size + msg_len - pending, 4096)
+        return 64 * 1024
+
+    @property
+    def pending(self) -> int:
+        return self._end - self._start
+
+    def frames(self):
+        """Yields the payload of every complete frame in the buffer"""
+        with memoryview(self._buf) as view:
+            while self._end - self._start >= HEADER.size:
+                (msg_len,) = HEADER.unpack_from(view, self._start)
+                if msg_len > self.max_size:
+                    raise ValueError(f"Message too large: {msg_len} > {self.max_size}")
+                frame_end = self._start + HEADER.size + msg_len
+                if frame_end > self._end:
+                    break
+                payload = view[self._start + HEADER.size : frame_end]
+                self._start = frame_end
+                try:
+                    yield payload
+                finally:
+                    payload.release()
+        if self._start == self._end:
+            self._start = self._end = 0
+
 
 class NativeMessaging:
     def __init__(self, in_stream=sys.stdin.buffer, out_stream=sys.stdout.buffer):
         self.in_stream = in_stream
         self.out_stream = out_stream
+        self._decoder = FrameDecoder()
+        self._loop = None
+        # length prefixes and bodies, written out together by os.writev()
+        self._out_queue: collections.deque[bytes | memoryview] = collections.deque()
+        self._flush_scheduled = False
+        self._write_watcher = None
+        self.io_watcher = None
+        self.reading = True  # see stop_reading()
+        self.closed = False  # see detach()
+        self.stats = collections.Counter()  # posted, writes, bytes_written, write_blocked, ...
 
-    def _get_message(self, stream: BinaryIO):
-        length_data = os.read(stream.fileno(), 4)
-        if not length_data:
-            raise EOFError
-        msg_len = struct.unpack("@I", length_data)[0]
-        message_data = os.read(stream.fileno(), msg_len)
-        if len(message_data) != msg_len:
-            raise ValueError(f"Expected {msg_len} bytes, got {len(message_data)}")
-        return json.loads(message_data)
+    def _get_messages(self, fd):
+        """
+        Drains `fd` and decodes all complete messages. Undecodable messages are returned as
+        exceptions, and EOF is signaled by a trailing None.
+        """
+        is_open = self._decoder.fill(fd)
+        messages = []
+        try:
+            for payload in self._decoder.frames():
+                try:
+                    messages.append(json.loads(str(payload, "utf-8")))
+                except ValueError as e:
+                    messages.append(e)
+        except ValueError as e:  # oversized frame, the stream can not be resynchronized
+            messages.append(e)
+            return messages
+        if not is_open:
+            if self._decoder.pending:
+                messages.append(ValueError(f"EOF inside a message: {self._decoder.pending} bytes"))
+            else:
+                messages.append(None)
+        return messages
 
     def _encode_message(self, message_content):
         encoded_content = json.dumps(message_content, separators=(",", ":")).encode("utf-8")
-        encoded_length = struct.pack("@I", len(encoded_content))
+        if len(encoded_content) > MAX_OUTGOING_MESSAGE_SIZE:
+            raise ValueError(
+                f"Message too large: {len(encoded_content)} > {MAX_OUTGOING_MESSAGE_SIZE}"
+            )
+        encoded_length = HEADER.pack(len(encoded_content))
         return encoded_length, encoded_content
 
+    @property
+    def queue_depth(self) -> int:
+        """Number of posted messages not (fully) written yet"""
+        return (len(self._out_queue) + 1) // 2
+
     def post(self, message):
+        """
+        Queues `message`. Messages posted in the same loop tick are written with a single
+        writev() call; without a loop (or before one is attached) they are written right away.
+        """
+        if self.closed:
+            self.stats["dropped"] += 1
+            return
         encoded_length, encoded_content = self._encode_message(message)
-        self.out_stream.write(encoded_length)
-        self.out_stream.write(encoded_content)
-        self.out_stream.flush()
+        self._out_queue.append(encoded_length)
+        self._out_queue.append(encoded_content)
+        self.stats["posted"] += 1
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.queue_depth)
+        if not self._loop:
+            self.flush()
+        elif not (self._flush_scheduled or self._write_watcher):
+            self._flush_scheduled = True
+            self._loop.call_soon(self._on_writable)
+
+    def _write_pending(self) -> bool:
+        """Writes as much of the queue as the pipe takes. Returns True once it is empty"""
+        fd = self.out_stream.fileno()
+        while self._out_queue:
+            try:
+                n = os.writev(fd, list(itertools.islice(self._out_queue, IOV_MAX)))
+            except BlockingIOError:
+                return False
+            self.stats["writes"] += 1
+            self.stats["bytes_written"] += n
+            while n:
+                head = self._out_queue[0]
+                if n < len(head):
+                    self._out_queue[0] = memoryview(head)[n:]
+                    break
+                n -= len(head)
+                self._out_queue.popleft()
+        return True
+
+    def _on_writable(self, *args):
+        self._flush_scheduled = False
+        if self.closed:
+            return
+        if self._write_pending():
+            if self._write_watcher:
+                self._loop.unregister_io_watch(self._write_watcher)
+                self._write_watcher = None
+        elif not self._write_watcher:
+            # the pipe is full: wait for the browser to read instead of blocking the loop
+            self.stats["write_blocked"] += 1
+            self._write_watcher = self._loop.register_io_watch(
+                self.out_stream.fileno(), self._on_writable, writable=True
+            )
+
+    def flush(self):
+        """Writes out the whole queue, blocking if needed"""
+        fd = self.out_stream.fileno()
+        while not self._write_pending():
+            select.select([], [fd], [])
+
+    def close(self):
+        with contextlib.suppress(OSError):
+            self.flush()
+
+    def stop_reading(self):
+        """Stops watching the input stream: what is posted until detach() is still written out"""
+        self.reading = False
+        if self._loop and self.io_watcher:
+            self._loop.unregister_io_watch(self.io_watcher)
+        self.io_watcher = None
+
+    def detach(self):
+        """Writes out what is queued and stops watching the streams, so that they can be closed"""
+        self.stop_reading()
+        self.close()
+        self.closed = True
+        if self._loop:
+            if self._write_watcher:
+                self._loop.unregister_io_watch(self._write_watcher)
+                self._write_watcher = None
 
     def listen(self, cb):
+        fd = self.in_stream.fileno()
+        os.set_blocking(fd, False)
         while True:
+            select.select([fd], [], [])
             self._process(cb)
 
     def _process(self, cb):
+        """Hands every message received so far to `cb`, then None on EOF or the error if any"""
         try:
-            msg = self._get_message(self.in_stream)
-        except EOFError:
-            msg = None
+            messages = self._get_messages(self.in_stream.fileno())
         except Exception as e:
-            msg = e
-        cb(msg)
-        return msg
+            messages = [e]
+        for msg in messages:
+            cb(msg)
+        return messages
 
-    def register_listener(self, cb, register_io_watch):
+    def register_listener(self, cb, loop):
         def _on_data_ready(*args):
-            # logger.debug("NativeMessaging::_on_data_ready() wacther=%r  cb_args=%r", self.io_watcher, args)
-            msg = self._process(cb)
-            logger.debug("Native message was processed successfully: %r", msg)
+            messages = self._process(cb)
+            logger.debug("%d native message(s) were processed successfully", len(messages))
 
-        self.io_watcher = register_io_watch(self.in_stream.fileno(), _on_data_ready)
+        os.set_blocking(self.in_stream.fileno(), False)
+        os.set_blocking(self.out_stream.fileno(), False)
+        self._loop = loop
+        self.io_watcher = loop.register_io_watch(self.in_stream.fileno(), _on_data_ready)
         logger.debug("Registered io watcher ref=%r", self.io_watcher)
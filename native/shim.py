@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Native messaging host: forwards the frames between the browser (stdin/stdout) and the per-user
+companion daemon (main.py --daemon) over its Unix socket, starting the daemon if needed.
+
+The daemon keeps the X connection, the apps and their tray icons when the browser port goes
+away, so that reconnecting (extension reload, browser restart) only costs starting this shim.
+The frames are forwarded as they are: the daemon reads the same length-prefixed format.
+"""
+
+import os
+import select
+import socket
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from daemon import connect_or_spawn
+
+BUFFER_SIZE = 256 * 1024
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def forward(sock: socket.socket):
+    stdin, stdout = sys.stdin.buffer.fileno(), sys.stdout.buffer.fileno()
+    fds = [stdin, sock.fileno()]
+    while True:
+        readable, _, _ = select.select(fds, [], [])
+        if stdin in readable:
+            if data := os.read(stdin, BUFFER_SIZE):
+                sock.sendall(data)
+            else:  # the browser closed the port: the daemon replies to what it got, then closes
+                sock.shutdown(socket.SHUT_WR)
+                fds.remove(stdin)
+        if sock.fileno() in readable:
+            if not (data := sock.recv(BUFFER_SIZE)):
+                return
+            write_all(stdout, data)
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg == "--startup-report"]
+    try:
+        sock = connect_or_spawn(args)
+    except OSError as e:
+        print(f"Could not connect to the companion daemon: {e}", file=sys.stderr, flush=True)
+        sys.exit(1)
+    with sock:
+        forward(sock)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import logging
+import threading
+
+logger = logging.getLogger("main")
+
+# window states of x11_window_control.WindowStateTracker
+STATE_MARKERS = {"focused": "●", "visible": "●", "hidden": "○"}
+
+
+class AggregatedTrayEntry:
+    """
+    Stands in for the tray icon of one app in the aggregated tray, with the same interface
+    as SystrayIcon. Changes only mark the shared menu for a rebuild.
+    """
+
+    def __init__(self, tray: "AggregatedTray", id):
+        self._tray = tray
+        self.id = id
+        self.title = id
+        self.icon = None
+        self.state = None
+        self.menu_items = []
+        self.on_activate = None
+        self.parked = False
+
+    def set_icon(self, icon):
+        self.icon = icon
+        self._tray.invalidate()
+
+    def set_title(self, title):
+        self.title = title
+        self._tray.invalidate()
+
+    def set_state(self, state):
+        """Window state, shown as a marker in front of the app: see STATE_MARKERS"""
+        if state != self.state:
+            self.state = state
+            self._tray.invalidate()
+
+    def show_message(self, title, text):
+        self._tray.show_message(title, text)
+
+    def hide(self):
+        self.release()
+
+    def show(self):
+        self.parked = False
+        self._tray.invalidate()
+
+    def release(self):
+        self.parked = True
+        self._tray.invalidate()
+
+    def dispose(self):
+        self._tray.discard(self.id)
+
+
+class AggregatedTray:
+    """
+    A single tray icon for all the apps, with a submenu per app holding its usual actions.
+
+    The menu is built by the UI thread when it is about to be shown (or, for providers that
+    must export it ahead, rebuilt once per batch of changes), from a snapshot of the entries.
+    """
+
+    def __init__(self, provider, *, id="tabapps", title="Tab Apps", icon=None):
+        self._provider = provider
+        self._id = id
+        self._title = title
+        self._icon = icon
+        self._lock = threading.Lock()
+        self._entries: dict[str, AggregatedTrayEntry] = {}  # app id => entry, in launch order
+        self._tray_icon = None  # provider's SystrayIcon, while at least one app is shown
+
+    def acquire(self, id, *, icon, title, menu_items, on_activate) -> AggregatedTrayEntry:
+        with self._lock:
+            if not (entry := self._entries.get(id)):
+                entry = self._entries[id] = AggregatedTrayEntry(self, id)
+        entry.icon, entry.title = icon, title
+        entry.menu_items, entry.on_activate = menu_items, on_activate
+        entry.parked = False
+        self.invalidate()
+        return entry
+
+    def discard(self, id):
+        with self._lock:
+            self._entries.pop(id, None)
+        self.invalidate()
+
+    def _shown_entries(self) -> list[AggregatedTrayEntry]:
+        with self._lock:
+            return [e for e in self._entries.values() if not e.parked]
+
+    def invalidate(self):
+        """Called after any change of the entries"""
+        shown = self._shown_entries()
+        if shown and not self._tray_icon:
+            self._tray_icon = self._provider.acquire(
+                id=self._id,
+                icon=self._icon,
+                title=self._title,
+                menu_items=self._build_menu,
+                on_activate=self._on_activate,
+            )
+        elif not shown and self._tray_icon:
+            self._tray_icon.release()
+            self._tray_icon = None
+        if self._tray_icon:
+            self._tray_icon.set_title(f"{self._title}: {', '.join(e.title for e in shown)}")
+            self._tray_icon.invalidate_menu()
+
+    def _build_menu(self):
+        """Runs on the UI thread"""
+        items = []
+        for e in self._shown_entries():
+            marker = STATE_MARKERS.get(e.state, " ")
+            items.append((f"{marker} {e.title}", list(e.menu_items)))
+        return items
+
+    def _on_activate(self, *args):
+        # with a single app, clicking the icon toggles it, as its own icon would
+        if len(shown := self._shown_entries()) == 1 and shown[0].on_activate:
+            shown[0].on_activate(*args)
+
+    def show_message(self, title, text):
+        if self._tray_icon:
+            self._tray_icon.show_message(title, text)
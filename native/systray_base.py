@@ -0,0 +1,70 @@
+from functools import partial
+
+from tray_icon_cache import TrayIconCache
+
+
+class PooledSystrayIcon:
+    """
+    Tray icon of an app. Icons are pooled by app id: release() parks (hides) the icon and
+    acquire() shows it again, rebound to the new callbacks, instead of building a new one.
+
+    The toolkit specific part is left to the providers: _bind(), hide(), _destroy() and
+    call_in_ui(), and their ICON_CACHE of decoded icons.
+    """
+
+    ICON_CACHE: TrayIconCache = None
+    _pool: dict[str, "PooledSystrayIcon"]  # app id => icon, shown or parked
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._pool = {}
+
+    @classmethod
+    def acquire(cls, id, *, icon, title, menu_items, on_activate) -> "PooledSystrayIcon":
+        if not (o := cls._pool.get(id)):
+            o = cls._pool[id] = cls(id)
+        o._bind(icon, title, menu_items, on_activate)
+        return o
+
+    def __init__(self, id):
+        self.id = id
+
+    def _bind(self, icon, title, menu_items, on_activate):
+        raise NotImplementedError
+
+    def hide(self):
+        raise NotImplementedError
+
+    def _destroy(self):
+        raise NotImplementedError
+
+    def set_state(self, state):
+        """App window state, only shown in the aggregated tray (see systray_aggregated)"""
+
+    def release(self):
+        """Parks the icon, for a later acquire() of the same app"""
+        self.hide()
+
+    @classmethod
+    def discard(cls, id):
+        """Destroys the icon of app `id`, shown or parked"""
+        if o := cls._pool.get(id):
+            o.dispose()
+
+    def dispose(self):
+        """Destroys the icon, once the app is gone for good"""
+        if self._pool.get(self.id) is self:
+            del self._pool[self.id]
+        self._destroy()
+
+    @classmethod
+    def evict_icon(cls, icon):
+        cls.call_in_ui(partial(cls.ICON_CACHE.evict, icon))
+
+    @classmethod
+    def icon_cache_stats(cls):
+        return dict(cls.ICON_CACHE.stats)
+
+    @classmethod
+    def call_in_ui(cls, fn):
+        raise NotImplementedError
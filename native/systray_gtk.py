@@ -3,7 +3,11 @@ import functools
 import gi
 
 gi.require_version("Gtk", "3.0")
-from gi.repository import GLib, GObject, Gtk
+gi.require_version("GdkPixbuf", "2.0")
+from gi.repository import GdkPixbuf, GLib, GObject, Gtk
+
+from systray_base import PooledSystrayIcon
+from tray_icon_cache import TrayIconCache, nearest_size
 
 # Make sure Gtk works
 if not Gtk.init_check()[0]:
@@ -23,6 +27,14 @@ except ValueError:
 AppIndicator = None
 
 
+def _decode_pixbufs(path, sizes):
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+    return {s: pixbuf.scale_simple(s, s, GdkPixbuf.InterpType.BILINEAR) for s in sizes}
+
+
+ICON_CACHE = TrayIconCache(_decode_pixbufs)
+
+
 def glib_loop(f):
     @functools.wraps(f)
     def inner(*args, **kwargs):
@@ -37,53 +49,38 @@ def glib_loop(f):
     return inner
 
 
-import sys
+class SystrayIcon(PooledSystrayIcon):
+    """Gtk.StatusIcon (or AppIndicator) based provider, see PooledSystrayIcon"""
 
+    ICON_CACHE = ICON_CACHE
 
-class SystrayIcon:
-    _SYSTRAY_SINGLETON_CACHE = {}
     _loop = None
 
-    def __new__(cls, id, *, icon, title, menu_items, on_activate):
-        if o := cls._SYSTRAY_SINGLETON_CACHE.get(id):
-            print("Cache hit", (id, icon, title, menu_items), file=sys.stderr, flush=True)
-            o.set_icon(icon)
-            o.set_title(title)
-            return o
-        print("Cache miss", (id, icon, title, menu_items), file=sys.stderr, flush=True)
-        o = super(SystrayIcon, cls).__new__(cls)
-        cls._SYSTRAY_SINGLETON_CACHE[id] = o
-        return o
-
-    def __init__(self, id, icon, title, menu_items, on_activate):
-        print("Init()", id, file=sys.stderr, flush=True)
-        self.id = id
-        self._setup(icon, title, menu_items, on_activate)
-
-    @glib_loop
-    def _setup(self, icon, title, menu_items, on_activate):
-        g_menu = Gtk.Menu.new()
-        for it in menu_items:
-            if it == "SEPARATOR":
-                g_menu.append(Gtk.SeparatorMenuItem())
-                continue
-            label, cb = it
-            g_menu_item = Gtk.MenuItem.new_with_label(label)
-            g_menu_item.connect("activate", cb, label)
-            g_menu.append(g_menu_item)
-        g_menu.show_all()
+    def __init__(self, id):
+        super().__init__(id)
+        self._g_appindicator = None
+        self._g_status_icon = None
+        self._g_menu = None
+        self._menu_labels = None
+        self._menu_callbacks = []
+        self._build_menu_items = None
+        self._on_activate = None
+        self._pixbufs = None
+        self._icon = None
+        self._title = None
 
+    def _create(self):
         if AppIndicator:
             g_appindicator = AppIndicator.Indicator.new(
                 self.id, "", AppIndicator.IndicatorCategory.APPLICATION_STATUS
             )
-            g_appindicator.set_status(AppIndicator.IndicatorStatus.ACTIVE)
-            g_appindicator.set_menu(g_menu)
             self._g_appindicator = g_appindicator
         else:
 
             def _on_popup_menu(g_status_icon, button, activate_time):
-                g_menu.popup(
+                if self._build_menu_items:
+                    self._set_menu(self._build_g_menu(self._build_menu_items()))
+                self._g_menu.popup(
                     None,
                     None,
                     Gtk.StatusIcon.position_menu,
@@ -93,60 +90,176 @@ class SystrayIcon:
                 )
 
             def _on_activate(icon):
-                on_activate()
+                self._on_activate()
+
+            def _on_size_changed(g_status_icon, size):
+                if self._pixbufs:
+                    g_status_icon.set_from_pixbuf(self._pixbufs[nearest_size(size)])
+                return True
 
             g_status_icon = Gtk.StatusIcon.new()
             g_status_icon.connect("activate", _on_activate)
             g_status_icon.connect("popup-menu", _on_popup_menu)
-            g_status_icon.set_visible(True)
+            g_status_icon.connect("size-changed", _on_size_changed)
             self._g_status_icon = g_status_icon
 
-        self.set_title(title)
-        self.set_icon(icon)
+    @glib_loop
+    def _bind(self, icon, title, menu_items, on_activate):
+        if not (self._g_appindicator or self._g_status_icon):
+            self._create()
+        self._on_activate = on_activate
+        if callable(menu_items):
+            # built when the menu pops up, or right away for the indicator, which exports it
+            self._build_menu_items = menu_items
+            self._menu_labels = None
+            if AppIndicator:
+                self._set_menu(self._build_g_menu(menu_items()))
+        else:
+            self._build_menu_items = None
+            self._bind_menu(menu_items)
+        self._set_title(title)
+        self._set_icon(icon)
+        self._show()
+
+    def _bind_menu(self, menu_items):
+        self._menu_callbacks = [None if it == "SEPARATOR" else it[1] for it in menu_items]
+        labels = [it if it == "SEPARATOR" else it[0] for it in menu_items]
+        if labels != self._menu_labels:
+            g_menu = Gtk.Menu.new()
+            for i, label in enumerate(labels):
+                if label == "SEPARATOR":
+                    g_menu.append(Gtk.SeparatorMenuItem())
+                    continue
+                g_menu_item = Gtk.MenuItem.new_with_label(label)
+                g_menu_item.connect("activate", self._on_menu_item, i, label)
+                g_menu.append(g_menu_item)
+            g_menu.show_all()
+            self._set_menu(g_menu)
+            self._menu_labels = labels
+
+    @classmethod
+    def _build_g_menu(cls, menu_items):
+        """Builds a menu, with a submenu for items of the form (label, [menu items])"""
+        g_menu = Gtk.Menu.new()
+        for it in menu_items:
+            if it == "SEPARATOR":
+                g_menu.append(Gtk.SeparatorMenuItem())
+                continue
+            label, target = it
+            g_menu_item = Gtk.MenuItem.new_with_label(label)
+            if isinstance(target, list):
+                g_menu_item.set_submenu(cls._build_g_menu(target))
+            else:
+                g_menu_item.connect("activate", lambda _, cb=target, label=label: cb(label))
+            g_menu.append(g_menu_item)
+        g_menu.show_all()
+        return g_menu
+
+    def _set_menu(self, g_menu):
+        if self._g_menu:
+            self._g_menu.destroy()
+        if AppIndicator:
+            self._g_appindicator.set_menu(g_menu)
+        self._g_menu = g_menu
 
     @glib_loop
-    def set_icon(self, icon):
-        if not icon:
+    def invalidate_menu(self):
+        """Lazy menus are rebuilt when they pop up, except the exported menu of the indicator"""
+        if AppIndicator and self._build_menu_items and self._g_appindicator:
+            self._set_menu(self._build_g_menu(self._build_menu_items()))
+
+    def _on_menu_item(self, g_menu_item, index, label):
+        self._menu_callbacks[index](label)
+
+    def _set_icon(self, icon):
+        if not icon or icon == self._icon:
             return
         if AppIndicator:
             self._g_appindicator.set_icon(str(icon))
         else:
-            self._g_status_icon.set_from_file(str(icon))
+            self._pixbufs = ICON_CACHE.get(icon)
+            size = nearest_size(self._g_status_icon.get_size())
+            self._g_status_icon.set_from_pixbuf(self._pixbufs[size])
+        self._icon = icon
 
-    @glib_loop
-    def set_title(self, title):
+    def _set_title(self, title):
+        if title == self._title:
+            return
         if AppIndicator:
-            return self._g_appindicator.set_title(title)
-        return self._g_status_icon.set_title(title)
+            self._g_appindicator.set_title(title)
+        else:
+            self._g_status_icon.set_title(title)
+        self._title = title
 
-    @glib_loop
-    def hide(self):
+    def _show(self):
+        if AppIndicator:
+            self._g_appindicator.set_status(AppIndicator.IndicatorStatus.ACTIVE)
+        else:
+            self._g_status_icon.set_visible(True)
+
+    def _hide(self):
         if AppIndicator:
             self._g_appindicator.set_status(AppIndicator.IndicatorStatus.PASSIVE)
         else:
             self._g_status_icon.set_visible(False)
 
+    @glib_loop
+    def set_icon(self, icon):
+        if self._g_appindicator or self._g_status_icon:
+            self._set_icon(icon)
+
+    @glib_loop
+    def set_title(self, title):
+        if self._g_appindicator or self._g_status_icon:
+            self._set_title(title)
+
+    @glib_loop
+    def hide(self):
+        self._hide()
+
     @glib_loop
     def show(self):
-        if AppIndicator:
-            self._g_appindicator.set_status(AppIndicator.IndicatorStatus.ACTIVE)
-        else:
-            self._g_status_icon.set_visible(True)
+        self._show()
+
+    @glib_loop
+    def _destroy(self):
+        if self._g_appindicator or self._g_status_icon:
+            self._hide()
+        if self._g_menu:
+            self._g_menu.destroy()
+        self._g_appindicator = self._g_status_icon = self._g_menu = self._pixbufs = None
+
+    @glib_loop
+    def show_message(self, title, text):
+        # neither the status icon nor the indicator can show notifications: use a dialog
+        dialog = Gtk.MessageDialog(
+            message_type=Gtk.MessageType.INFO, buttons=Gtk.ButtonsType.CLOSE, text=title
+        )
+        dialog.format_secondary_text(text)
+        dialog.connect("response", lambda d, _: d.destroy())
+        dialog.show()
+
+    @classmethod
+    def call_in_ui(cls, fn):
+        """Thread-safe: runs `fn` on the GLib main loop"""
+        glib_loop(fn)()
 
     @classmethod
     def get_loop(cls):
         if not cls._loop:
             cls._loop = GLib.MainLoop.new(None, False)
 
-            def register_io_watch(
-                fd,
-                on_data_ready,
-                flag=GLib.IOCondition.IN | GLib.IOCondition.ERR | GLib.IOCondition.HUP,
-            ):
+            def register_io_watch(fd, on_data_ready, writable=False):
+                flag = GLib.IOCondition.ERR | GLib.IOCondition.HUP
+                flag |= GLib.IOCondition.OUT if writable else GLib.IOCondition.IN
                 chan = GLib.IOChannel.unix_new(fd)
                 # GLib removes the watch when handler returns False
-                GLib.io_add_watch(chan, flag, lambda ch, cond: bool(on_data_ready()) or True)
-                return chan
+                return GLib.io_add_watch(chan, flag, lambda ch, cond: bool(on_data_ready()) or True)
+
+            def call_soon(cb):
+                GLib.idle_add(lambda: bool(cb()) and False)
 
             cls._loop.register_io_watch = register_io_watch
+            cls._loop.unregister_io_watch = GLib.source_remove
+            cls._loop.call_soon = call_soon
         return cls._loop
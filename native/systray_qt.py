@@ -1,67 +1,192 @@
+import functools
 import sys
 from functools import partial
 
-from PyQt5.QtCore import QSocketNotifier
-from PyQt5.QtGui import QIcon
+from PyQt5.QtCore import QObject, QSocketNotifier, Qt, QTimer, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import QIcon, QPixmap
 from PyQt5.QtWidgets import QAction, QApplication, QMenu, QSystemTrayIcon, QWidget
 
+from systray_base import PooledSystrayIcon
+from tray_icon_cache import TrayIconCache
 
-class SystrayIcon:
-    _loop = None
 
-    def __init__(self, id, *, icon, title, menu_items, on_activate):
-        self.id = id
-        self._setup(icon, title, menu_items, on_activate)
+class _UiInvoker(QObject):
+    """Runs callables on the thread it was created in (the Qt GUI thread)"""
 
-    def _setup(self, icon, title, menu_items, on_activate):
-        self.q_tray_icon = QSystemTrayIcon()
-        q_menu = QMenu()
+    invoke = pyqtSignal(object)
 
-        for it in menu_items:
-            if it == "SEPARATOR":
-                continue
-            label, cb = it
-            q_action = QAction(label, q_menu)
-            q_action.triggered.connect(partial(cb, label))
-            q_menu.addAction(q_action)
+    def __init__(self):
+        super().__init__()
+        self.invoke.connect(self._run)
 
-        self.q_tray_icon.activated.connect(on_activate)
-        self.q_tray_icon.setContextMenu(q_menu)
-        self.q_tray_icon.show()
-        self.q_tray_icon.setIcon(QIcon(str(icon)))
-        self.q_tray_icon.setToolTip(title)
+    @pyqtSlot(object)
+    def _run(self, fn):
+        fn()
+
+
+def _decode_q_icon(path, sizes):
+    pixmap = QPixmap(path)
+    if pixmap.isNull():
+        return QIcon(path)
+    q_icon = QIcon()
+    for size in sizes:
+        q_icon.addPixmap(pixmap.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+    return q_icon
+
+
+ICON_CACHE = TrayIconCache(_decode_q_icon)
+
+
+def qt_loop(f):
+    @functools.wraps(f)
+    def inner(*args, **kwargs):
+        SystrayIcon.call_in_ui(partial(f, *args, **kwargs))
+
+    return inner
+
+
+_LAZY_MENU = object()  # _menu_labels of lazily built menus
+
+
+class SystrayIcon(PooledSystrayIcon):
+    """QSystemTrayIcon based provider, see PooledSystrayIcon"""
 
+    ICON_CACHE = ICON_CACHE
+
+    _loop = None
+    _invoker = None
+
+    def __init__(self, id):
+        super().__init__(id)
+        self.q_tray_icon = None
+        self._q_menu = None
+        self._menu_labels = None
+        self._menu_callbacks = []
+        self._build_menu_items = None
+        self._on_activate = None
+        self._icon = None
+        self._title = None
+
+    @qt_loop
+    def _bind(self, icon, title, menu_items, on_activate):
+        if not self.q_tray_icon:
+            self.q_tray_icon = QSystemTrayIcon()
+            self.q_tray_icon.activated.connect(lambda *args: self._on_activate(*args))
+        self._on_activate = on_activate
+        if callable(menu_items):
+            self._bind_lazy_menu(menu_items)
+        else:
+            self._bind_menu(menu_items)
+        self._set_icon(icon)
+        self._set_title(title)
         self.q_tray_icon.show()
 
+    def _bind_menu(self, menu_items):
+        menu_items = [it for it in menu_items if it != "SEPARATOR"]
+        self._menu_callbacks = [cb for _, cb in menu_items]
+        if (labels := [label for label, _ in menu_items]) != self._menu_labels:
+            q_menu = QMenu()
+            for i, label in enumerate(labels):
+                q_action = QAction(label, q_menu)
+                q_action.triggered.connect(partial(self._on_menu_item, i, label))
+                q_menu.addAction(q_action)
+            self.q_tray_icon.setContextMenu(q_menu)
+            self._q_menu, self._menu_labels = q_menu, labels
+
+    def _bind_lazy_menu(self, build_menu_items):
+        """`build_menu_items()` is called each time the menu is about to be shown"""
+        self._build_menu_items = build_menu_items
+        if self._menu_labels is not _LAZY_MENU:
+            q_menu = QMenu()
+            q_menu.aboutToShow.connect(lambda: self._populate(q_menu, self._build_menu_items()))
+            self.q_tray_icon.setContextMenu(q_menu)
+            self._q_menu, self._menu_labels = q_menu, _LAZY_MENU
+
+    @classmethod
+    def _populate(cls, q_menu, menu_items):
+        """Fills `q_menu`, with a submenu for items of the form (label, [menu items])"""
+        q_menu.clear()
+        for it in menu_items:
+            if it == "SEPARATOR":
+                q_menu.addSeparator()
+                continue
+            label, target = it
+            if isinstance(target, list):
+                cls._populate(q_menu.addMenu(label), target)
+            else:
+                q_menu.addAction(label).triggered.connect(partial(target, label))
+
+    @qt_loop
+    def invalidate_menu(self):
+        """Lazy menus are rebuilt when shown: nothing to do"""
+
+    def _on_menu_item(self, index, label, *args):
+        self._menu_callbacks[index](label)
+
+    def _set_icon(self, icon):
+        if icon and icon != self._icon:
+            self.q_tray_icon.setIcon(ICON_CACHE.get(icon))
+            self._icon = icon
+
+    def _set_title(self, title):
+        if title != self._title:
+            self.q_tray_icon.setToolTip(title)
+            self._title = title
+
+    @qt_loop
     def set_icon(self, icon):
-        if not icon:
-            return
-        self.q_tray_icon.setIcon(QIcon(str(icon)))
+        if self.q_tray_icon:
+            self._set_icon(icon)
 
+    @qt_loop
     def set_title(self, title):
-        self.q_tray_icon.setToolTip(title)
+        if self.q_tray_icon:
+            self._set_title(title)
 
+    @qt_loop
     def hide(self):
         self.q_tray_icon.hide()
 
+    @qt_loop
     def show(self):
         self.q_tray_icon.show()
 
-    def dispose(self):
-        self.q_tray_icon.hide()
-        self.q_tray_icon.deleteLater()
-        self.q_tray_icon = None
+    @qt_loop
+    def _destroy(self):
+        if self.q_tray_icon:
+            self.q_tray_icon.hide()
+            self.q_tray_icon.deleteLater()
+            self.q_tray_icon = self._q_menu = None
+
+    @qt_loop
+    def show_message(self, title, text):
+        self.q_tray_icon.showMessage(title, text, QSystemTrayIcon.Information)
+
+    @classmethod
+    def call_in_ui(cls, fn):
+        """Thread-safe: runs `fn` on the GUI thread (right away when called from it)"""
+        cls.get_loop()
+        cls._invoker.invoke.emit(fn)
 
     @classmethod
     def get_loop(cls):
         if not cls._loop:
             cls._loop = QApplication.instance() or QApplication(sys.argv)
             cls._loop.run = cls._loop.exec_
+            cls._invoker = _UiInvoker()
 
-            def register_io_watch(fd, on_data_ready):
-                qsn = QSocketNotifier(fd, QSocketNotifier.Read)
+            def register_io_watch(fd, on_data_ready, writable=False):
+                qsn = QSocketNotifier(
+                    fd, QSocketNotifier.Write if writable else QSocketNotifier.Read
+                )
                 qsn.activated.connect(on_data_ready)
                 return qsn
 
+            def unregister_io_watch(qsn):
+                qsn.setEnabled(False)
+                qsn.deleteLater()
+
             cls._loop.register_io_watch = register_io_watch
+            cls._loop.unregister_io_watch = unregister_io_watch
+            cls._loop.call_soon = lambda cb: QTimer.singleShot(0, cb)
         return cls._loop
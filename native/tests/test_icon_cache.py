@@ -0,0 +1,146 @@
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from icon_cache import IconCache
+
+
+class IconHandler(http.server.BaseHTTPRequestHandler):
+    """
+    /<size>.png: `size` bytes, with an ETag, answering 304 to a matching If-None-Match.
+    /chunked/<size>.png: the same without Content-Length
+    """
+
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-None-Match")))
+        size = int(self.path.rsplit("/", 1)[1].split(".")[0])
+        etag = f'"{size}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("ETag", etag)
+        if not self.path.startswith("/chunked/"):
+            self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.write(bytes([size % 256]) * size)
+
+    def log_message(self, *args):
+        pass
+
+
+class IconCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), IconHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = self._tmp.name
+        IconHandler.requests.clear()
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}/{path}"
+
+    def cache(self, **kwargs) -> IconCache:
+        cache = IconCache(self.cache_dir, **kwargs)
+        self.addCleanup(cache.shutdown)
+        return cache
+
+    def test_fetch(self):
+        cache = self.cache()
+        path = cache.fetch(self.url("100.png"))
+        self.assertEqual(path.read_bytes(), bytes([100]) * 100)
+        self.assertEqual(path.suffix, ".png")
+        self.assertEqual(cache.get_cached(self.url("100.png")), path)
+        self.assertEqual(cache.stats["fetched"], 1)
+
+    def test_index_is_persistent(self):
+        path = self.cache().fetch(self.url("100.png"))
+        self.assertEqual(self.cache().get_cached(self.url("100.png")), path)
+
+    def test_revalidation(self):
+        cache = self.cache()
+        path = cache.fetch(self.url("100.png"))
+        self.assertEqual(cache.fetch(self.url("100.png")), path)
+        self.assertEqual(IconHandler.requests[-1], ("/100.png", '"100"'))
+        self.assertEqual(cache.stats["not_modified"], 1)
+
+    def test_missing_content_length(self):
+        cache = self.cache(max_icon_size=1000)
+        self.assertEqual(cache.fetch(self.url("chunked/300.png")).stat().st_size, 300)
+        with self.assertRaises(ValueError):  # enforced while reading
+            cache.fetch(self.url("chunked/2000.png"))
+
+    def test_size_cap(self):
+        cache = self.cache(max_icon_size=1000)
+        with self.assertRaises(ValueError):
+            cache.fetch(self.url("2000.png"))
+        self.assertIsNone(cache.get_cached(self.url("2000.png")))
+
+    def test_fetch_async(self):
+        done = threading.Event()
+        results = []
+
+        def on_done(path, error):
+            results.append((path, error))
+            done.set()
+
+        self.cache().fetch_async(self.url("100.png"), on_done)
+        self.assertTrue(done.wait(5))
+        self.assertIsNone(results[0][1])
+        self.assertTrue(results[0][0].exists())
+
+    def test_lru_eviction(self):
+        cache = self.cache(max_cache_size=500)
+        a = cache.fetch(self.url("200.png"))
+        b = cache.fetch(self.url("201.png"))
+        time.sleep(0.01)
+        cache.get_cached(self.url("200.png"))  # a hit makes it the most recently used
+        c = cache.fetch(self.url("202.png"))
+        self.assertTrue(a.exists())
+        self.assertFalse(b.exists())
+        self.assertTrue(c.exists())
+        self.assertIsNone(cache.get_cached(self.url("201.png")))
+
+    def test_pinned_files_are_not_evicted(self):
+        cache = self.cache(max_cache_size=500)
+        a = cache.fetch(self.url("200.png"))
+        cache.pin(a)
+        b = cache.fetch(self.url("201.png"))
+        c = cache.fetch(self.url("202.png"))
+        self.assertTrue(a.exists())
+        self.assertFalse(b.exists())
+        self.assertTrue(c.exists())
+        cache.unpin(a)
+        cache.fetch(self.url("203.png"))
+        self.assertFalse(a.exists())
+
+    def test_oversized_entry_is_kept(self):
+        cache = self.cache(max_cache_size=500)
+        path = cache.fetch(self.url("600.png"))
+        self.assertTrue(path.exists())
+        self.assertEqual(cache.get_cached(self.url("600.png")), path)
+
+
+if __name__ == "__main__":
+    unittest.main()
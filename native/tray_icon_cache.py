@@ -0,0 +1,79 @@
+import hashlib
+import logging
+import os
+import threading
+
+logger = logging.getLogger("main")
+
+# sizes the tray icons are actually rendered at by the panels
+TRAY_ICON_SIZES = (16, 22, 24, 32, 48)
+DEFAULT_ICON_FILE = os.path.join(os.path.dirname(__file__), "icon.png")
+
+
+def nearest_size(size, sizes=TRAY_ICON_SIZES):
+    return min(sizes, key=lambda s: (abs(s - size), -s)) if size > 0 else 22
+
+
+class TrayIconCache:
+    """
+    Process-wide cache of decoded tray icons, keyed by the content hash of the icon file.
+
+    `decode(path, sizes)` is the toolkit specific part: it decodes the file once and returns
+    the icon pre-scaled to `sizes`. Icons are kept until evicted, so that rebuilding the tray
+    icon of a relaunched app does not decode the file again. A file that cannot be read or
+    decoded gets the `fallback` icon instead.
+    """
+
+    def __init__(self, decode, sizes=TRAY_ICON_SIZES, fallback=DEFAULT_ICON_FILE):
+        self._decode = decode
+        self.sizes = sizes
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._icons = {}  # content hash => decoded icon
+        self._digests = {}  # path => (mtime_ns, size, content hash)
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "errors": 0}
+
+    def _digest(self, path: str) -> str:
+        st = os.stat(path)
+        cached = self._digests.get(path)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self._digests[path] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def get(self, path):
+        path = str(path)
+        try:
+            return self._get(path)
+        except Exception as e:  # gone, or not an image (e.g. an HTML error page served as 200)
+            if path == self.fallback:
+                raise
+            logger.warning("Could not load tray icon %s, using the default one: %r", path, e)
+            self.stats["errors"] += 1
+            return self._get(self.fallback)
+
+    def _get(self, path):
+        with self._lock:
+            digest = self._digest(path)
+            if (icon := self._icons.get(digest)) is not None:
+                self.stats["hits"] += 1
+                return icon
+            self.stats["misses"] += 1
+            icon = self._icons[digest] = self._decode(path, self.sizes)
+            logger.debug(f"Decoded tray icon {path} at sizes {self.sizes}")
+            return icon
+
+    def evict(self, path):
+        """Drops the icon of `path`, unless another cached path has the same content"""
+        path = str(path)
+        with self._lock:
+            if not (cached := self._digests.pop(path, None)):
+                return
+            digest = cached[2]
+            if any(d[2] == digest for d in self._digests.values()):
+                return
+            if self._icons.pop(digest, None) is not None:
+                self.stats["evictions"] += 1
+                logger.debug(f"Evicted tray icon {path}")
@@ -0,0 +1,94 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable
+
+from metrics import metrics
+
+logger = logging.getLogger("main")
+
+
+@dataclass
+class _WatchedLoop:
+    name: str
+    post: Callable  # thread-safe: runs its argument on the loop
+    thread: threading.Thread
+    pending_since: float = None  # time.monotonic() of the heartbeat in flight
+    stack: str = None  # captured once the heartbeat is late
+
+
+class LoopWatchdog:
+    """
+    Detects stalled event loops.
+
+    A thread posts heartbeats to each watched loop. When a heartbeat is not run within
+    `threshold` seconds, the stack of the loop's thread is captured and logged, so the blocking
+    call shows up; the total stall duration is reported once the loop gets to the heartbeat.
+    Heartbeat delays go to the `loop_lag.<name>` histogram, stalls to `stall.<name>`.
+    """
+
+    def __init__(self, threshold=0.25):
+        self.threshold = threshold
+        self.interval = threshold / 2
+        self.last_stalls = {}  # name => {"at", "duration_ms", "stack"}
+        self._loops: list[_WatchedLoop] = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="tabapps-watchdog", daemon=True)
+
+    def watch(self, name, post, thread: threading.Thread):
+        self._loops.append(_WatchedLoop(name, post, thread))
+
+    def start(self):
+        logger.debug(f"Watchdog started: {[w.name for w in self._loops]} {self.threshold=}s")
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            now = time.monotonic()
+            for w in self._loops:
+                with self._lock:
+                    if w.pending_since is None:
+                        w.pending_since = now
+                        post_heartbeat = True
+                    else:
+                        post_heartbeat = False
+                        late = w.stack is None and now - w.pending_since > self.threshold
+                        if late:
+                            w.stack = self._capture_stack(w.thread)
+                if post_heartbeat:
+                    w.post(partial(self._on_heartbeat, w))
+                elif late:
+                    metrics.inc(f"stalls.{w.name}")
+                    logger.warning(
+                        f"The {w.name} loop is stalled for {(now - w.pending_since) * 1000:.0f}ms,"
+                        f" in:\n{w.stack}"
+                    )
+
+    @staticmethod
+    def _capture_stack(thread: threading.Thread) -> str:
+        if frame := sys._current_frames().get(thread.ident):
+            return "".join(traceback.format_stack(frame))
+        return "<no stack>"
+
+    def _on_heartbeat(self, w: _WatchedLoop):
+        """Runs on the watched loop"""
+        with self._lock:
+            lag = time.monotonic() - w.pending_since
+            stack, w.pending_since, w.stack = w.stack, None, None
+        metrics.observe(f"loop_lag.{w.name}", lag)
+        if stack:
+            metrics.observe(f"stall.{w.name}", lag)
+            self.last_stalls[w.name] = {
+                "at": time.time(),
+                "duration_ms": round(lag * 1000, 1),
+                "stack": stack,
+            }
+            logger.warning(f"The {w.name} loop was stalled for {lag * 1000:.0f}ms")
@@ -0,0 +1,172 @@
+import collections
+import dataclasses
+import re
+from dataclasses import dataclass, field
+
+# rule field => X property it needs, besides the title
+RULE_PROPERTIES = {"wm_class": "WM_CLASS", "pid": "_NET_WM_PID", "role": "WM_WINDOW_ROLE"}
+
+
+@dataclass(frozen=True)
+class WindowRule:
+    """Window selector: all the given fields must match"""
+
+    title_substring: str = None
+    title_regex: str = None
+    wm_class: str = None  # instance or class part of WM_CLASS
+    pid: int = None
+    role: str = None
+
+    @classmethod
+    def from_message(cls, msg: dict) -> "WindowRule | None":
+        """
+        From an app-launch message: its `windowSelector`, with `windowTitleFingerprint` as the
+        title substring if the selector has no title criterion. None if it selects nothing
+        """
+        selector = msg.get("windowSelector") or {}
+        rule = cls(
+            title_substring=selector.get("titleFingerPrint") or None,
+            title_regex=selector.get("titleRegex") or None,
+            wm_class=selector.get("wmClass") or None,
+            pid=selector.get("pid") or None,
+            role=selector.get("role") or None,
+        )
+        if not (rule.title_substring or rule.title_regex) and msg.get("windowTitleFingerprint"):
+            rule = dataclasses.replace(rule, title_substring=msg["windowTitleFingerprint"])
+        return rule if rule != cls() else None
+
+    @property
+    def properties(self) -> set[str]:
+        return {prop for name, prop in RULE_PROPERTIES.items() if getattr(self, name) is not None}
+
+
+class AhoCorasick:
+    """Finds which of many substrings occur in a text, in one pass over the text"""
+
+    def __init__(self, patterns: list[str]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail = [0]
+        self._out: list[set[int]] = [set()]
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for ch in pattern:
+                if (nxt := self._goto[node].get(ch)) is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(set())
+                node = nxt
+            self._out[node].add(index)
+        queue = collections.deque(self._goto[0].values())
+        while queue:  # breadth first, so that the fail links of shorter prefixes are known
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0) if node else 0
+                self._out[nxt] |= self._out[self._fail[nxt]]
+
+    def search(self, text: str) -> set[int]:
+        """Indexes of the patterns found in `text`"""
+        found = set()
+        node = 0
+        for ch in text:
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            found |= self._out[node]
+        return found
+
+
+@dataclass
+class AppMatch:
+    app_id: str
+    window: object  # first matching window, in client list order
+    candidates: list = field(default_factory=list)  # all matching windows
+    shared_with: set[str] = field(default_factory=set)  # other apps matching `window`
+
+    @property
+    def ambiguous(self) -> bool:
+        return len(self.candidates) > 1 or bool(self.shared_with)
+
+
+class WindowMatcher:
+    """
+    Resolves the windows of many apps at once.
+
+    Every rule is compiled together: the title substrings of all rules into one Aho-Corasick
+    automaton, so that each window title is scanned once whatever the number of apps. Only
+    the rules whose substring was found (or which have none) are then checked field by field.
+    An app matches a window if any of its rules does.
+    """
+
+    def __init__(self):
+        self._rules: list[tuple[str, WindowRule]] = []
+        self._compiled = None
+
+    def add(self, app_id: str, *rules: WindowRule):
+        self._rules.extend((app_id, rule) for rule in rules if rule)
+        self._compiled = None
+
+    def __bool__(self):
+        return bool(self._rules)
+
+    @property
+    def properties(self) -> set[str]:
+        """X properties needed by the rules, besides the title"""
+        return set().union(*(rule.properties for _, rule in self._rules))
+
+    def _compile(self):
+        substrings = {}  # substring => its index in the automaton
+        by_substring = collections.defaultdict(list)  # substring index => rule indexes
+        unconditional = []  # rule indexes without a substring
+        for i, (_, rule) in enumerate(self._rules):
+            if rule.title_substring is None:
+                unconditional.append(i)
+            else:
+                index = substrings.setdefault(rule.title_substring, len(substrings))
+                by_substring[index].append(i)
+        regexes = {
+            i: re.compile(r.title_regex) for i, (_, r) in enumerate(self._rules) if r.title_regex
+        }
+        self._compiled = (AhoCorasick(list(substrings)), by_substring, unconditional, regexes)
+
+    def _rule_matches(self, rule: WindowRule, regex, attrs: dict) -> bool:
+        if regex and not regex.search(attrs.get("title") or ""):
+            return False
+        if rule.wm_class is not None and rule.wm_class not in (attrs.get("wm_class") or ()):
+            return False
+        if rule.pid is not None and rule.pid != attrs.get("pid"):
+            return False
+        if rule.role is not None and rule.role != attrs.get("role"):
+            return False
+        return True
+
+    def match(self, windows) -> dict[str, AppMatch]:
+        """
+        `windows` yields (window, attrs) in client list order, attrs holding the title and the
+        properties needed by the rules (wm_class, pid, role). Returns the matches by app id.
+        """
+        if self._compiled is None:
+            self._compile()
+        automaton, by_substring, unconditional, regexes = self._compiled
+        matches: dict[str, AppMatch] = {}
+        for window, attrs in windows:
+            title = attrs.get("title") or ""
+            rule_indexes = [i for s in automaton.search(title) for i in by_substring[s]]
+            matched_apps = []
+            for i in sorted(rule_indexes + unconditional):
+                app_id, rule = self._rules[i]
+                if app_id in matched_apps or not self._rule_matches(rule, regexes.get(i), attrs):
+                    continue
+                matched_apps.append(app_id)
+                if not (m := matches.get(app_id)):
+                    m = matches[app_id] = AppMatch(app_id, window)
+                m.candidates.append(window)
+            for app_id in matched_apps:
+                if matches[app_id].window is window:
+                    matches[app_id].shared_with.update(a for a in matched_apps if a != app_id)
+        return matches
@@ -0,0 +1,90 @@
+import logging
+import time
+from dataclasses import dataclass
+
+from window_matcher import AppMatch, WindowMatcher, WindowRule
+
+logger = logging.getLogger("main")
+
+
+@dataclass
+class PendingResolution:
+    app_id: str
+    rule: WindowRule
+    deadline: float  # time.monotonic()
+    delay: float  # of the next fallback retry
+    timer: object = None  # loop.call_later() handle
+    timer_fired: bool = False
+
+
+class WindowResolver:
+    """
+    Queue of the apps whose window was not found yet (not mapped yet, or title not updated).
+
+    Pending apps are matched again, all in one pass, whenever the client windows change
+    (see windows_changed()), and on a timer with exponential backoff in case no relevant event
+    comes. `on_resolved(app_id, match)` is called once the window is found, or with None once
+    the deadline passed. The app ids are opaque keys, as given to add(), and so are the ids in
+    the `shared_with` of the matches. Must be used from `loop`, the one of the X11 worker.
+    """
+
+    def __init__(self, loop, match, on_resolved, *, timeout=10, first_delay=0.1, max_delay=2):
+        self._loop = loop
+        self._match = match  # WindowMatcher => {app id: AppMatch}
+        self._on_resolved = on_resolved
+        self.timeout = timeout
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        self._pending: dict[str, PendingResolution] = {}
+        self._retry_scheduled = False
+
+    def add(self, app_id, rule: WindowRule):
+        """Waits for the window of `app_id`, replacing any earlier request for the app"""
+        self.cancel(app_id)
+        if not rule:
+            return self._on_resolved(app_id, None)
+        logger.debug(
+            "[app_id=%r] Window not found yet, waiting up to %ss: %s", app_id, self.timeout, rule
+        )
+        p = self._pending[app_id] = PendingResolution(
+            app_id, rule, time.monotonic() + self.timeout, self.first_delay
+        )
+        self._schedule_fallback(p)
+
+    def cancel(self, app_id):
+        if p := self._pending.pop(app_id, None):
+            p.timer.cancel()
+
+    def windows_changed(self):
+        """A client window was added or retitled: retry soon, once per loop iteration"""
+        if self._pending and not self._retry_scheduled:
+            self._retry_scheduled = True
+            self._loop.call_soon(self._retry)
+
+    def _schedule_fallback(self, p: PendingResolution):
+        delay = min(p.delay, max(0, p.deadline - time.monotonic()))
+        p.timer = self._loop.call_later(delay, self._on_timer, p)
+        p.timer_fired = False
+        p.delay = min(p.delay * 2, self.max_delay)
+
+    def _on_timer(self, p: PendingResolution):
+        p.timer_fired = True
+        self._retry()
+
+    def _retry(self):
+        self._retry_scheduled = False
+        if not self._pending:
+            return
+        matcher = WindowMatcher()
+        for p in self._pending.values():
+            matcher.add(p.app_id, p.rule)
+        matches: dict[str, AppMatch] = self._match(matcher)
+        now = time.monotonic()
+        for app_id, p in list(self._pending.items()):
+            if (match := matches.get(app_id)) or now >= p.deadline:
+                self.cancel(app_id)
+                if not match:
+                    logger.info(f"[{app_id=}] No window found within {self.timeout}s: {p.rule}")
+                self._on_resolved(app_id, match)
+            elif p.timer_fired:
+                self._schedule_fallback(p)
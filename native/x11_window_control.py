@@ -1,3 +1,5 @@
+import collections
+import contextlib
 import logging
 import re
 import subprocess
@@ -10,50 +12,385 @@ from typing import Literal
 import Xlib.display
 import Xlib.error
 import Xlib.protocol.event
+import Xlib.protocol.request
 import Xlib.X
 import Xlib.Xatom
 import Xlib.xobject
 
+from window_matcher import AppMatch, WindowMatcher
+
 # https://github.com/python-xlib/python-xlib
 
 logger = logging.getLogger("main")
 
-display = Xlib.display.Display()
+display: Xlib.display.Display = None  # see open_display()
+
+
+def open_display():
+    """Connects to the X server, deferred from import time to keep the companion startup fast"""
+    global display
+    if display is None:
+        display = Xlib.display.Display()
+    return display
+
+
+class RoundTripCounter:
+    """
+    Counts the blocking waits on the X server, and the requests sent, per high level operation.
+
+    Nested operations are rolled up into the outermost one.
+    """
+
+    def __init__(self):
+        self.totals = collections.Counter()
+        self.calls = collections.Counter()
+        self.requests = collections.Counter()
+        self.last = {}
+        self._stack = []
+
+    @staticmethod
+    def _request_serial():
+        return display.display.request_serial if display else 0
+
+    @contextlib.contextmanager
+    def operation(self, name: str):
+        self._stack.append([name, 0, self._request_serial()])
+        try:
+            yield
+        finally:
+            name, count, first_serial = self._stack.pop()
+            if self._stack:
+                self._stack[-1][1] += count
+            else:
+                self.totals[name] += count
+                self.calls[name] += 1
+                self.requests[name] += (self._request_serial() - first_serial) % 65536
+                self.last[name] = count
+                logger.debug("x11::%s() used %d round trip(s)", name, count)
+
+    def add(self, count=1):
+        if self._stack:
+            self._stack[-1][1] += count
+        else:
+            self.totals["<unscoped>"] += count
+
+    def as_dict(self) -> dict:
+        return {
+            name: {"calls": self.calls[name], "round_trips": rt, "requests": self.requests[name]}
+            for name, rt in self.totals.items()
+        }
+
+
+round_trips = RoundTripCounter()
+
+
+class AtomTable:
+    """
+    Two-way atom cache: name => id and id => name.
+
+    Names are interned in pipelined batches (one round trip per batch), and ids seen in
+    property replies are resolved to names once, so that state checks can compare ids.
+    """
+
+    def __init__(self):
+        self._ids: dict[str, int] = {}
+        self._names: dict[int, str] = {}
+
+    def _store(self, name: str, atom: int):
+        self._ids[name] = atom
+        self._names[atom] = name
+        display.display._atom_cache[name] = atom  # also serves Xlib's own get_atom() calls
+
+    def intern(self, names):
+        if not (missing := [n for n in dict.fromkeys(names) if n not in self._ids]):
+            return
+        requests = [
+            Xlib.protocol.request.InternAtom(
+                display=display.display, defer=True, name=name, only_if_exists=False
+            )
+            for name in missing
+        ]
+        round_trips.add()
+        for name, r in zip(missing, requests):
+            r.reply()
+            self._store(name, r.atom)
+
+    def names(self, atoms) -> list[str]:
+        if missing := [a for a in dict.fromkeys(atoms) if a not in self._names]:
+            requests = [
+                Xlib.protocol.request.GetAtomName(display=display.display, defer=True, atom=atom)
+                for atom in missing
+            ]
+            round_trips.add()
+            for atom, r in zip(missing, requests):
+                r.reply()
+                self._store(r.name, atom)
+        return [self._names[a] for a in atoms]
+
+    def name(self, atom: int) -> str:
+        return self._names.get(atom) or self.names([atom])[0]
+
+    def __getitem__(self, name: str) -> int:
+        if (atom := self._ids.get(name)) is None:
+            self.intern([name])
+            atom = self._ids[name]
+        return atom
+
+
+# Every atom this module uses, interned in one batch by X11WindowControl()
+EWMH_ATOM_NAMES = [
+    "UTF8_STRING",
+    "WM_STATE",
+    "WM_CHANGE_STATE",
+    "_NET_CLIENT_LIST",
+    "_NET_ACTIVE_WINDOW",
+    "_NET_CLOSE_WINDOW",
+    "_NET_WM_NAME",
+    "_NET_WM_PID",
+    "WM_WINDOW_ROLE",
+    "_NET_WM_STATE",
+    "_NET_WM_STATE_MODAL",
+    "_NET_WM_STATE_STICKY",
+    "_NET_WM_STATE_MAXIMIZED_VERT",
+    "_NET_WM_STATE_MAXIMIZED_HORZ",
+    "_NET_WM_STATE_SHADED",
+    "_NET_WM_STATE_SKIP_TASKBAR",
+    "_NET_WM_STATE_SKIP_PAGER",
+    "_NET_WM_STATE_HIDDEN",
+    "_NET_WM_STATE_FULLSCREEN",
+    "_NET_WM_STATE_ABOVE",
+    "_NET_WM_STATE_BELOW",
+    "_NET_WM_STATE_DEMANDS_ATTENTION",
+    "_NET_WM_ALLOWED_ACTIONS",
+    "_NET_WM_ACTION_MOVE",
+    "_NET_WM_ACTION_RESIZE",
+    "_NET_WM_ACTION_MINIMIZE",
+    "_NET_WM_ACTION_SHADE",
+    "_NET_WM_ACTION_STICK",
+    "_NET_WM_ACTION_MAXIMIZE_HORZ",
+    "_NET_WM_ACTION_MAXIMIZE_VERT",
+    "_NET_WM_ACTION_FULLSCREEN",
+    "_NET_WM_ACTION_CHANGE_DESKTOP",
+    "_NET_WM_ACTION_CLOSE",
+]
+
+atoms = AtomTable()
+
+# GetProperty reply size (in 32-bit units) asked for up front; longer values need a second pass
+PROPERTY_PREFETCH_LENGTH = 1024
+
+
+def _decode_text(prop):
+    if prop.format != 8:
+        return None
+    if prop.property_type == Xlib.Xatom.STRING:
+        return prop.value.decode("latin-1")
+    if prop.property_type == atoms["UTF8_STRING"]:
+        return prop.value.decode("utf-8")
+    return prop.value
+
+
+def _decode_wm_class(prop):
+    parts = (_decode_text(prop) or "").split("\0")
+    return (parts[0], parts[1]) if len(parts) >= 2 else None
+
+
+def _decode_card32(prop):
+    """The first CARDINAL, or WINDOW id"""
+    return prop.value[0] if prop.format == 32 and len(prop.value) else None
+
+
+def _decode_card32_list(prop):
+    return list(prop.value) if prop.format == 32 else []
+
+
+def _decode_wm_state(prop):
+    return {"state": prop.value[0], "icon": prop.value[1]} if len(prop.value) >= 2 else None
+
+
+# property name => (requested type, decoder)
+PROPERTY_SPECS = {
+    "_NET_CLIENT_LIST": (Xlib.Xatom.WINDOW, _decode_card32_list),
+    "_NET_WM_NAME": ("UTF8_STRING", _decode_text),
+    "_NET_WM_PID": (Xlib.Xatom.CARDINAL, _decode_card32),
+    "_NET_WM_STATE": (Xlib.Xatom.ATOM, _decode_card32_list),
+    "_NET_WM_ALLOWED_ACTIONS": (Xlib.Xatom.ATOM, _decode_card32_list),
+    "WM_NAME": (Xlib.Xatom.STRING, _decode_text),
+    "WM_CLASS": (Xlib.Xatom.STRING, _decode_wm_class),
+    "WM_STATE": ("WM_STATE", _decode_wm_state),
+    "WM_TRANSIENT_FOR": (Xlib.Xatom.WINDOW, _decode_card32),
+    "WM_WINDOW_ROLE": (Xlib.Xatom.STRING, _decode_text),
+    "_NET_ACTIVE_WINDOW": (Xlib.Xatom.WINDOW, _decode_card32),
+}
+
+# window attributes of WindowMatcher rules => property. Set by the clients before mapping their
+# windows: they are fetched once per window and not tracked
+STATIC_PROPERTY_ATTRIBUTES = {
+    "WM_CLASS": "wm_class",
+    "_NET_WM_PID": "pid",
+    "WM_WINDOW_ROLE": "role",
+}
+
+
+class PropertyCookie:
+    """Pending GetProperty request, resolved by PropertyBatch.fetch()"""
+
+    __slots__ = ("window", "name", "property_type", "decode", "_request", "value", "error")
+
+    def __init__(self, window, name, property_type, decode):
+        self.window = window
+        self.name = name
+        self.property_type = property_type
+        self.decode = decode
+        self._request = self._send(0, PROPERTY_PREFETCH_LENGTH)
+        self.value = None
+        self.error = None
+
+    def _send(self, offset, length):
+        # defer=True only queues the request, the reply is read by the first reply() call
+        return Xlib.protocol.request.GetProperty(
+            display=display.display,
+            defer=True,
+            delete=False,
+            window=self.window,
+            property=atoms[self.name],
+            type=self.property_type,
+            long_offset=offset,
+            long_length=length,
+        )
+
+    @staticmethod
+    def _wait(request):
+        request.reply()
+        if not request.property_type:  # property is not set
+            return None
+        request.format, request.value = request.value
+        return request
+
+
+class PropertyBatch:
+    """
+    Pipelined property fetching, in the manner of xcb cookies.
+
+    All GetProperty requests of the batch are written out before the first reply is
+    awaited, so fetching any number of properties costs a single round trip (plus one more
+    for the rare values longer than PROPERTY_PREFETCH_LENGTH).
+    """
+
+    def __init__(self):
+        self._cookies: list[PropertyCookie] = []
+
+    def get(self, window: Xlib.xobject.drawable.Window, name: str, property_type=None):
+        spec_type, decode = PROPERTY_SPECS.get(name, (Xlib.X.AnyPropertyType, lambda p: p.value))
+        property_type = spec_type if property_type is None else property_type
+        if isinstance(property_type, str):
+            property_type = atoms[property_type]
+        cookie = PropertyCookie(window, name, property_type, decode)
+        self._cookies.append(cookie)
+        return cookie
+
+    def fetch(self):
+        cookies, self._cookies = self._cookies, []
+        if not cookies:
+            return cookies
+        round_trips.add()
+        truncated = []
+        for cookie in cookies:
+            try:
+                prop = cookie._wait(cookie._request)
+            except Xlib.error.XError as e:
+                cookie.error = e
+                continue
+            if prop and prop.bytes_after:
+                truncated.append(
+                    (
+                        cookie,
+                        prop,
+                        cookie._send(PROPERTY_PREFETCH_LENGTH, prop.bytes_after // 4 + 1),
+                    )
+                )
+                continue
+            cookie.value = prop and cookie.decode(prop)
+        if truncated:
+            round_trips.add()
+        for cookie, prop, request in truncated:
+            try:
+                rest = cookie._wait(request)
+            except Xlib.error.XError as e:
+                cookie.error = e
+                continue
+            if rest:
+                prop.value = prop.value + rest.value
+            cookie.value = cookie.decode(prop)
+        return cookies
+
+
+def fetch_properties(windows, names) -> dict[int, dict[str, object]]:
+    """Fetches the given properties of all windows in one pipelined pass: {wid: {name: value}}"""
+    batch = PropertyBatch()
+    for w in windows:
+        for name in names:
+            batch.get(w, name)
+    result = {}
+    for cookie in batch.fetch():
+        result.setdefault(cookie.window.id, {})[cookie.name] = cookie.value
+    return result
 
 
 def get_text_property(window: Xlib.xobject.drawable.Window, atom_name: str, utf8=True):
-    atom = display.get_atom(atom_name)
-    return window.get_full_text_property(
-        atom, display.get_atom("UTF8_STRING") if utf8 else Xlib.Xatom.STRING
-    )
+    batch = PropertyBatch()
+    cookie = batch.get(window, atom_name, "UTF8_STRING" if utf8 else Xlib.Xatom.STRING)
+    cookie.decode = _decode_text
+    batch.fetch()
+    if cookie.error:
+        raise cookie.error
+    return cookie.value
+
+
+def get_wm_transient_for(window: Xlib.xobject.drawable.Window):
+    batch = PropertyBatch()
+    cookie = batch.get(window, "WM_TRANSIENT_FOR")
+    batch.fetch()
+    if cookie.error:
+        raise cookie.error
+    return cookie.value and display.create_resource_object("window", cookie.value)
+
+
+def get_net_client_list_ids() -> list[int]:
+    batch = PropertyBatch()
+    cookie = batch.get(display.screen().root, "_NET_CLIENT_LIST", Xlib.X.AnyPropertyType)
+    batch.fetch()
+    return cookie.value or []
 
 
 def get_net_client_list():
     # window_list_iter = display.screen().root.query_tree().children
-    return [
-        display.create_resource_object("window", winid)
-        for winid in display.screen()
-        .root.get_full_property(display.get_atom("_NET_CLIENT_LIST"), Xlib.X.AnyPropertyType)
-        .value
-    ]
+    return [display.create_resource_object("window", winid) for winid in get_net_client_list_ids()]
 
 
 def list_non_transient_windows():
     # https://github.com/nicolaselie/pykuli/blob/master/app/x11.py
-    for w in get_net_client_list():
-        transient_for = w.get_wm_transient_for()
-        if transient_for:
+    windows = get_net_client_list()
+    props = fetch_properties(windows, ["WM_TRANSIENT_FOR"])
+    for w in windows:
+        if props[w.id]["WM_TRANSIENT_FOR"]:
             continue
         yield w
 
 
 def search_windows(*, name: str | re.Pattern):
-    for w in list_non_transient_windows():
-        wm_name = get_text_property(w, "_NET_WM_NAME") or w.get_wm_name() or ""
+    windows = list(list_non_transient_windows())
+    props = fetch_properties(windows, ["_NET_WM_NAME", "WM_NAME"])
+    for w in windows:
+        wm_name = props[w.id]["_NET_WM_NAME"] or props[w.id]["WM_NAME"] or ""
         if name.search(wm_name) if isinstance(name, re.Pattern) else (name in wm_name):
             yield w
 
 
+def get_net_wm_state_atoms(window: Xlib.xobject.drawable.Window) -> list[int]:
+    return fetch_properties([window], ["_NET_WM_STATE"])[window.id]["_NET_WM_STATE"] or []
+
+
 def get_net_wm_state(window: Xlib.xobject.drawable.Window):
     # https://specifications.freedesktop.org/wm-spec/1.3/ar01s05.html
     # _NET_WM_STATE, , ATOM[]
@@ -69,8 +406,7 @@ def get_net_wm_state(window: Xlib.xobject.drawable.Window):
     #       _NET_WM_STATE_ABOVE
     #       _NET_WM_STATE_BELOW
     #       _NET_WM_STATE_DEMANDS_ATTENTION
-    state = window.get_full_property(display.get_atom("_NET_WM_STATE"), Xlib.Xatom.ATOM)
-    return [display.get_atom_name(i) for i in state.value]
+    return atoms.names(get_net_wm_state_atoms(window))
 
 
 def get_net_wm_allowed_actions(window: Xlib.xobject.drawable.Window):
@@ -85,28 +421,73 @@ def get_net_wm_allowed_actions(window: Xlib.xobject.drawable.Window):
     #     _NET_WM_ACTION_FULLSCREEN, ATOM
     #     _NET_WM_ACTION_CHANGE_DESKTOP, ATOM
     #     _NET_WM_ACTION_CLOSE, ATOM
-    allowed_actions = window.get_full_property(
-        display.get_atom("_NET_WM_ALLOWED_ACTIONS"), Xlib.Xatom.ATOM
-    )
-    return [display.get_atom_name(i) for i in allowed_actions.value]
-
-
-def send_event(window: Xlib.xobject.drawable.Window, data, event_type, event_mask):
+    allowed_actions = fetch_properties([window], ["_NET_WM_ALLOWED_ACTIONS"])[window.id]
+    return atoms.names(allowed_actions["_NET_WM_ALLOWED_ACTIONS"] or [])
+
+
+class EventBatch:
+    """
+    ClientMessages sent as a group.
+
+    Each event is only queued in the output buffer when added; the whole group is written
+    out by one sync() in send(), whose single round trip also collects the X error (if any)
+    of every event. The events are sent to the root window, so the X server never checks the
+    target window they are about: see X11WindowControl.apply_window_actions() for that.
+    """
+
+    def __init__(self):
+        self._catchers: list[Xlib.error.CatchError] = []
+
+    def add(self, event, event_mask) -> Xlib.error.CatchError:
+        catcher = Xlib.error.CatchError()
+        display.screen().root.send_event(event, event_mask=event_mask, onerror=catcher)
+        self._catchers.append(catcher)
+        return catcher
+
+    def send(self):
+        catchers, self._catchers = self._catchers, []
+        if catchers:
+            display.sync()
+            round_trips.add()
+
+
+_event_batch: EventBatch = None  # see batched_events()
+
+
+@contextlib.contextmanager
+def batched_events():
+    """send_event() calls within are sent together on exit, nested groups join the outer one"""
+    global _event_batch
+    if _event_batch:
+        yield _event_batch
+        return
+    _event_batch = EventBatch()
+    try:
+        yield _event_batch
+    finally:
+        batch, _event_batch = _event_batch, None
+        batch.send()
+
+
+def send_event(
+    window: Xlib.xobject.drawable.Window, data, event_type, event_mask
+) -> Xlib.error.CatchError:
+    """Returns the error catcher of the event, set once its group is sent: see batched_events()"""
     # http://code.google.com/p/pywo/source/browse/trunk/pywo/core/xlib.py
     event = Xlib.protocol.event.ClientMessage(
         window=window,
-        client_type=(event_type if isinstance(event_type, int) else display.get_atom(event_type)),
+        client_type=(event_type if isinstance(event_type, int) else atoms[event_type]),
         data=(32, (data)),
     )
-    logger.debug(f"x11::send_event() {display.get_atom_name(event.client_type)} {data=} {window=}")
-    display.screen().root.send_event(event, event_mask=event_mask)
-    display.sync()
+    logger.debug("x11::send_event() %s window=0x%x", event_type, window.id)
+    with batched_events() as batch:
+        return batch.add(event, event_mask)
 
 
 def iconify_window(window: Xlib.xobject.drawable.Window):
     # https://tronche.com/gui/x/icccm/sec-4.html#s-4.1.4
     # https://github.com/iwanbk/4.4BSD-Lite/blob/c995ba982d79d1ccaa1e8446d042f4c7f0442d5f/usr/src/contrib/X11R5-lib/lib/X/Iconify.c#L38
-    send_event(
+    return send_event(
         window,
         data=(Xlib.Xutil.IconicState, 0, 0, 0, 0),
         event_type="WM_CHANGE_STATE",
@@ -121,9 +502,9 @@ class NETWMStateAction(IntEnum):
 
 
 def change_skip_taskbar_state(window: Xlib.xobject.drawable.Window, action: NETWMStateAction):
-    send_event(
+    return send_event(
         window,
-        data=(action, display.get_atom("_NET_WM_STATE_SKIP_TASKBAR"), 0, 0, 0),
+        data=(action, atoms["_NET_WM_STATE_SKIP_TASKBAR"], 0, 0, 0),
         event_type="_NET_WM_STATE",
         event_mask=Xlib.X.SubstructureRedirectMask,
     )
@@ -131,7 +512,7 @@ def change_skip_taskbar_state(window: Xlib.xobject.drawable.Window, action: NETW
 
 def focus_windows(window: Xlib.xobject.drawable.Window):
     # https://specifications.freedesktop.org/wm-spec/wm-spec-1.3.html#idm46113623231184
-    send_event(
+    return send_event(
         window,
         data=(1, int(time.time()), 0, 0, 0),
         event_type="_NET_ACTIVE_WINDOW",
@@ -142,9 +523,9 @@ def focus_windows(window: Xlib.xobject.drawable.Window):
 def maximize_window(window: Xlib.xobject.drawable.Window, mode=None, vert=True, horz=True):
     if mode == None:
         mode = window.get_wm_state().state
-    horz = display.get_atom("_NET_WM_STATE_MAXIMIZED_HORZ") if horz else 0
-    vert = display.get_atom("_NET_WM_STATE_MAXIMIZED_VERT") if vert else 0
-    send_event(
+    horz = atoms["_NET_WM_STATE_MAXIMIZED_HORZ"] if horz else 0
+    vert = atoms["_NET_WM_STATE_MAXIMIZED_VERT"] if vert else 0
+    return send_event(
         window,
         data=(mode, horz, vert, 0, 0),
         event_type="_NET_WM_STATE",
@@ -153,13 +534,13 @@ def maximize_window(window: Xlib.xobject.drawable.Window, mode=None, vert=True,
 
 
 def restore_window(window: Xlib.xobject.drawable.Window, vert=True, horz=True):
-    maximize_window(window, mode=Xlib.Xutil.DontCareState, vert=vert, horz=horz)
+    return maximize_window(window, mode=Xlib.Xutil.DontCareState, vert=vert, horz=horz)
 
 
 def close_window(window: Xlib.xobject.drawable.Window):
     # https://specifications.freedesktop.org/wm-spec/1.3/ar01s04.html
     # window.destroy()
-    send_event(
+    return send_event(
         window,
         data=(0, 0, 0, 0, 0),
         event_type="_NET_CLOSE_WINDOW",
@@ -198,52 +579,343 @@ class CliUtils:
     window_quite = partial(xdotool_action, "windowquit")
 
 
+class WindowIndex:
+    """
+    In-memory index of the non-transient client windows, keyed by window id.
+
+    Filled once from _NET_CLIENT_LIST and then kept current from PropertyNotify
+    (_NET_CLIENT_LIST on the root window, _NET_WM_NAME on clients) and DestroyNotify
+    events, so that lookups never go to the X server.
+    """
+
+    CLIENT_EVENT_MASK = Xlib.X.PropertyChangeMask | Xlib.X.StructureNotifyMask
+
+    def __init__(self):
+        self.root = display.screen().root
+        self.windows: dict[int, Xlib.xobject.drawable.Window] = {}  # in _NET_CLIENT_LIST order
+        self._ignored_ids: set[int] = set()  # transient windows
+        self._frozen = 0
+        self.change_listeners = []  # called after windows were added or retitled
+        self.event_listeners = []  # called with each batch of processed events
+        self._net_client_list_atom = atoms["_NET_CLIENT_LIST"]
+        self._net_wm_name_atom = atoms["_NET_WM_NAME"]
+
+    def populate(self):
+        self.root.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
+        self._sync_client_list()
+        logger.debug(f"x11::WindowIndex populated with {len(self.windows)} windows")
+
+    def _sync_client_list(self):
+        client_ids = get_net_client_list_ids()
+        known_ids = self.windows.keys() | self._ignored_ids
+        for wid in known_ids - set(client_ids):
+            self._remove(wid)
+        self._add([wid for wid in client_ids if wid not in known_ids])
+
+    def _notify_change(self):
+        for cb in self.change_listeners:
+            cb()
+
+    def _add(self, wids: list[int]):
+        if not wids:
+            return
+        windows = [display.create_resource_object("window", wid) for wid in wids]
+        # select events before reading the properties so that no update is missed in between
+        for w in windows:
+            w.change_attributes(event_mask=self.CLIENT_EVENT_MASK, onerror=Xlib.error.CatchError())
+        batch = PropertyBatch()
+        cookies = [
+            (batch.get(w, "WM_TRANSIENT_FOR"), batch.get(w, "_NET_WM_NAME")) for w in windows
+        ]
+        batch.fetch()
+        for w, (transient_for, net_wm_name) in zip(windows, cookies):
+            if transient_for.error or net_wm_name.error:  # already gone
+                continue
+            if transient_for.value:
+                self._ignored_ids.add(w.id)
+                continue
+            w.title = net_wm_name.value
+            w.static_properties = {}
+            self.windows[w.id] = w
+        self._notify_change()
+
+    def _remove(self, wid: int):
+        self._ignored_ids.discard(wid)
+        self.windows.pop(wid, None)
+
+    def _refresh_title(self, w: Xlib.xobject.drawable.Window):
+        try:
+            w.title = get_text_property(w, "_NET_WM_NAME")
+        except (Xlib.error.BadWindow, Xlib.error.BadDrawable):
+            self._remove(w.id)
+        else:
+            self._notify_change()
+
+    def handle_event(self, event):
+        if event.type == Xlib.X.PropertyNotify:
+            if event.window == self.root:
+                if event.atom == self._net_client_list_atom:
+                    self._sync_client_list()
+            elif event.atom == self._net_wm_name_atom and (w := self.windows.get(event.window.id)):
+                self._refresh_title(w)
+        elif event.type == Xlib.X.DestroyNotify:
+            self._remove(event.window.id)
+
+    def process_pending_events(self):
+        # pending_events() only reads what is already on the socket, it does not round trip.
+        # Events arriving while a handler or listener waits on a reply are moved to the Xlib
+        # event queue, where the fd watch no longer sees them: loop until that queue is empty
+        while display.pending_events():
+            events = []
+            while display.pending_events():
+                events.append(event := display.next_event())
+                self.handle_event(event)
+            for cb in self.event_listeners:
+                cb(events)
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """Lookups made inside the block all see the same state of the client list"""
+        if not self._frozen:
+            self.process_pending_events()
+        self._frozen += 1
+        try:
+            yield self
+        finally:
+            self._frozen -= 1
+
+    def attributes(self, properties=()):
+        """
+        Yields (window, {"title", and the attributes of `properties`}) in client list order.
+        The static properties are fetched for the windows seen for the first time, in one batch.
+        """
+        if not self._frozen:
+            self.process_pending_events()
+        windows = list(self.windows.values())
+        if properties := set(properties):
+            missing = [w for w in windows if not properties <= w.static_properties.keys()]
+            if missing:
+                for wid, values in fetch_properties(missing, properties).items():
+                    self.windows[wid].static_properties.update(values)
+        for w in windows:
+            attrs = {STATIC_PROPERTY_ATTRIBUTES[p]: w.static_properties.get(p) for p in properties}
+            attrs["title"] = w.title
+            yield w, attrs
+
+    def search(self, *, name: str | re.Pattern):
+        if not self._frozen:
+            self.process_pending_events()
+        for w in list(self.windows.values()):
+            if not (wm_name := w.title):
+                continue
+            if name.search(wm_name) if isinstance(name, re.Pattern) else (name in wm_name):
+                yield w
+
+
+class WindowStateTracker:
+    """
+    State of the tracked (managed) windows: "hidden", "visible", "focused" or "closed".
+
+    Kept current from the PropertyNotify/DestroyNotify events the window index selects anyway:
+    the _NET_WM_STATE of the windows that changed and _NET_ACTIVE_WINDOW are refetched in one
+    batch per burst of events. `listeners` are called with (window, state) on every change of
+    the state or of the title.
+    """
+
+    def __init__(self, index: WindowIndex):
+        self._index = index
+        self._tracked: dict[int, Xlib.xobject.drawable.Window] = {}
+        self._net_wm_states: dict[int, set[int]] = {}
+        self._titles: dict[int, str] = {}
+        self.states: dict[int, str] = {}
+        self.active_window_id = None
+        self.listeners = []
+        index.event_listeners.append(self._on_events)
+
+    def track(self, w: Xlib.xobject.drawable.Window) -> str | None:
+        """Starts tracking `w`. Returns its state, None if it is gone"""
+        batch = PropertyBatch()
+        net_wm_state = batch.get(w, "_NET_WM_STATE")
+        active_window = batch.get(self._index.root, "_NET_ACTIVE_WINDOW")
+        batch.fetch()
+        if net_wm_state.error:
+            return None
+        self._tracked[w.id] = w
+        self._net_wm_states[w.id] = set(net_wm_state.value or ())
+        self._titles[w.id] = w.title
+        self.active_window_id = active_window.value
+        state = self.states[w.id] = self._state(w.id)
+        return state
+
+    def untrack(self, wid: int):
+        self._tracked.pop(wid, None)
+        self._net_wm_states.pop(wid, None)
+        self._titles.pop(wid, None)
+        self.states.pop(wid, None)
+
+    def is_hidden(self, wid: int) -> bool | None:
+        """None for windows that are not tracked"""
+        if wid in self._net_wm_states:
+            return atoms["_NET_WM_STATE_HIDDEN"] in self._net_wm_states[wid]
+        return None
+
+    def _state(self, wid: int) -> str:
+        if self.is_hidden(wid):
+            return "hidden"
+        return "focused" if wid == self.active_window_id else "visible"
+
+    def _notify(self, w, state):
+        for cb in self.listeners:
+            cb(w, state)
+
+    def _on_events(self, events):
+        if not self._tracked:
+            return
+        changed_ids, destroyed_ids, active_changed = set(), set(), False
+        for event in events:
+            if event.type == Xlib.X.PropertyNotify:
+                if event.window == self._index.root:
+                    active_changed |= event.atom == atoms["_NET_ACTIVE_WINDOW"]
+                elif event.window.id in self._tracked and event.atom == atoms["_NET_WM_STATE"]:
+                    changed_ids.add(event.window.id)
+            elif event.type == Xlib.X.DestroyNotify and event.window.id in self._tracked:
+                destroyed_ids.add(event.window.id)
+        for wid in destroyed_ids:
+            w = self._tracked[wid]
+            self.untrack(wid)
+            self._notify(w, "closed")
+        batch = PropertyBatch()
+        cookies = {
+            wid: batch.get(self._tracked[wid], "_NET_WM_STATE")
+            for wid in changed_ids - destroyed_ids
+        }
+        active_window = (
+            batch.get(self._index.root, "_NET_ACTIVE_WINDOW") if active_changed else None
+        )
+        batch.fetch()
+        for wid, cookie in cookies.items():
+            if not cookie.error:
+                self._net_wm_states[wid] = set(cookie.value or ())
+        if active_window and not active_window.error:
+            self.active_window_id = active_window.value
+        for wid, w in list(self._tracked.items()):
+            state = self._state(wid)
+            if state != self.states[wid] or w.title != self._titles[wid]:
+                self.states[wid], self._titles[wid] = state, w.title
+                self._notify(w, state)
+
+
+# window-action names => X11WindowControl methods
+WINDOW_ACTIONS = {
+    "iconify": "minimize_app_window",
+    "restore": "restore_app_window",
+    "close": "close_app_window",
+}
+
+
 class X11WindowControl:
-    @staticmethod
-    def find_app_window(title_fingerprint) -> dict[str, Xlib.xobject.drawable.Window]:
-        for w in list_non_transient_windows():
-            _net_wm_name = get_text_property(w, "_NET_WM_NAME")
-            # logger.debug(f"0x{w.id:x} {_net_wm_name}")
-            if _net_wm_name and title_fingerprint in _net_wm_name:
-                w.title = _net_wm_name
-                return w
+    def __init__(self):
+        open_display()
+        with round_trips.operation("intern_atoms"):
+            atoms.intern(EWMH_ATOM_NAMES)
+        self.window_index = WindowIndex()
+        with round_trips.operation("populate_window_index"):
+            self.window_index.populate()
+        self.window_states = WindowStateTracker(self.window_index)
+
+    def fileno(self):
+        return display.fileno()
+
+    def process_events(self, *args):
+        with round_trips.operation("process_events"):
+            self.window_index.process_pending_events()
+
+    def snapshot(self):
+        return self.window_index.snapshot()
+
+    def find_app_window(self, title_fingerprint) -> Xlib.xobject.drawable.Window | None:
+        with round_trips.operation("find_app_window"):
+            return next(self.window_index.search(name=title_fingerprint), None)
+
+    def match_app_windows(self, matcher: WindowMatcher) -> dict[str, AppMatch]:
+        """Resolves the windows of all the apps of `matcher` in one pass over the index"""
+        with round_trips.operation("match_app_windows"):
+            return matcher.match(self.window_index.attributes(matcher.properties))
+
+    def apply_window_actions(self, actions) -> list[str | None]:
+        """
+        Applies (window, action name) pairs, see WINDOW_ACTIONS, with a single flush and round
+        trip for all of them. Returns the error of each action or None: "gone" for a window
+        that is no longer known (nothing is sent), else the X error of the request if any
+        """
+        catchers = []
+        with round_trips.operation("apply_window_actions"), batched_events():
+            for w, action in actions:
+                known = w.id in self.window_index.windows or w.id in self.window_states.states
+                catchers.append(getattr(self, WINDOW_ACTIONS[action])(w) if known else None)
+        return [
+            "gone" if c is None else (error := c.get_error()) and type(error).__name__
+            for c in catchers
+        ]
 
     @staticmethod
     def init_window(window: Xlib.xobject.drawable.Window):
-        change_skip_taskbar_state(window, NETWMStateAction.Add)
+        with round_trips.operation("init_window"):
+            return change_skip_taskbar_state(window, NETWMStateAction.Add)
+
+    @staticmethod
+    def release_window(window: Xlib.xobject.drawable.Window):
+        """Undoes init_window() for an app that is dropped: back in the taskbar, and restored"""
+        with round_trips.operation("release_window"), batched_events():
+            change_skip_taskbar_state(window, NETWMStateAction.Remove)
+            return focus_windows(window)
 
     @staticmethod
     def minimize_app_window(window: Xlib.xobject.drawable.Window):
         # change_skip_taskbar_state(window, WMStateAction.Add)
         # CliUtils.window_minimize(window)
-        iconify_window(window)
+        with round_trips.operation("minimize_app_window"):
+            return iconify_window(window)
 
     @staticmethod
     def restore_app_window(window: Xlib.xobject.drawable.Window):
         # if taskbar:
         #     change_skip_taskbar_state(window, WMStateAction.Remove)
         # CliUtils.window_activate(window)
-        focus_windows(window)
+        with round_trips.operation("restore_app_window"):
+            return focus_windows(window)
 
     @staticmethod
     def close_app_window(window: Xlib.xobject.drawable.Window):
         # CliUtils.window_quite(window)
-        close_window(window)
+        with round_trips.operation("close_app_window"):
+            return close_window(window)
 
-    @staticmethod
-    def is_app_window_minimized(window: Xlib.xobject.drawable.Window):
-        return "_NET_WM_STATE_HIDDEN" in get_net_wm_state(window)
+    def is_app_window_minimized(self, window: Xlib.xobject.drawable.Window):
+        with round_trips.operation("is_app_window_minimized"):
+            self.window_index.process_pending_events()  # no round trip
+            if (hidden := self.window_states.is_hidden(window.id)) is not None:
+                return hidden  # tracked: from memory
+            return atoms["_NET_WM_STATE_HIDDEN"] in get_net_wm_state_atoms(window)
 
     @staticmethod
     def dump(window: Xlib.xobject.drawable.Window):
         out = partial(print, file=sys.stderr, flush=True)
+        names = [
+            "WM_CLASS",
+            "WM_NAME",
+            "_NET_WM_NAME",
+            "WM_STATE",
+            "_NET_WM_STATE",
+            "_NET_WM_ALLOWED_ACTIONS",
+        ]
+        with round_trips.operation("dump"):
+            props = fetch_properties([window], names)[window.id]
+            for name in ("_NET_WM_STATE", "_NET_WM_ALLOWED_ACTIONS"):
+                props[name] = atoms.names(props[name] or [])
         out(f"\nWindow: 0x{window.id:x}")
-        out("   WM_CLASS:", window.get_wm_class())
-        out("   WM_NAME:", window.get_wm_name())
-        out("   _NET_WM_NAME:", get_text_property(window, "_NET_WM_NAME"))
-        out("   WM_STATE:", window.get_wm_state())
-        out("   _NET_WM_STATE:", get_net_wm_state(window))
-        out("   _NET_WM_ALLOWED_ACTIONS:", get_net_wm_allowed_actions(window))
+        for name in names:
+            out(f"   {name}:", props[name])
 
 
 if __name__ == "__main__":
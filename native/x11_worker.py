@@ -0,0 +1,128 @@
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import threading
+
+from core_loop import CoreLoop
+
+logger = logging.getLogger("main")
+
+
+class X11Worker:
+    """
+    Thread owning the X display connection: Xlib is not thread-safe, so every X11 call goes
+    through it, and neither the UI loop nor the native messaging I/O ever waits on the X server.
+
+    Commands are submitted from any thread and run in order on the worker, each returning a
+    concurrent.futures.Future. Everything queued by the time the worker wakes up is run as one
+    drain, within one snapshot of the window index (the X events are processed once per drain,
+    not once per command). Read-only queries are coalesced on top of that: a query whose key is
+    already pending shares the future of the pending one.
+    """
+
+    def __init__(self, name="tabapps-x11"):
+        self.loop = CoreLoop(name)
+        self.window_ctl = None  # x11_window_control.X11WindowControl, see open()
+        self._lock = threading.Lock()
+        self._queue = collections.deque()  # (future, fn, args, query key)
+        self._queries: dict[object, concurrent.futures.Future] = {}  # key => pending future
+        self._drain_scheduled = False
+        self.stats = collections.Counter()  # commands, queries, coalesced, drains
+        self.on_connection_lost = None  # called once the X connection is closed, see open()
+        self._connection_errors = ()
+        self._io_watch = None
+
+    @property
+    def thread(self) -> threading.Thread:
+        return self.loop.thread
+
+    def in_worker_thread(self) -> bool:
+        return self.loop.in_core_thread()
+
+    def start(self):
+        self.loop.start()
+
+    def stop(self):
+        self.loop.stop()
+
+    def open(self):
+        """
+        Connects to the X server, to be called on the worker. Once the connection is lost, every
+        X11 call fails: `on_connection_lost()` is then called, once
+        """
+        from Xlib.error import ConnectionClosedError
+        from x11_window_control import X11WindowControl
+
+        self._connection_errors = (ConnectionClosedError,)
+        self.window_ctl = X11WindowControl()
+        self._io_watch = self.loop.register_io_watch(self.window_ctl.fileno(), self.process_events)
+        return self.window_ctl
+
+    def process_events(self, *args):
+        try:
+            self.window_ctl.process_events()
+        except self._connection_errors as e:
+            self._connection_lost(e)
+
+    def _connection_lost(self, error):
+        if not self._io_watch:
+            return
+        logger.error("Lost the X server connection: %r", error)
+        with contextlib.suppress(Exception):  # the fd may already be closed
+            self.loop.unregister_io_watch(self._io_watch)
+        self._io_watch = None
+        if self.on_connection_lost:
+            self.on_connection_lost()
+
+    def submit(self, fn, *args) -> concurrent.futures.Future:
+        """Runs `fn(*args)` on the worker, after everything submitted before"""
+        future = concurrent.futures.Future()
+        with self._lock:
+            self.stats["commands"] += 1
+            self._enqueue(future, fn, args)
+        return future
+
+    def query(self, key, fn, *args) -> concurrent.futures.Future:
+        """
+        Like submit(), for calls without side effects: while a query with the same `key` is
+        pending, it is returned instead of queuing another one
+        """
+        with self._lock:
+            self.stats["queries"] += 1
+            if future := self._queries.get(key):
+                self.stats["coalesced"] += 1
+                return future
+            future = self._queries[key] = concurrent.futures.Future()
+            self._enqueue(future, fn, args, key)
+        return future
+
+    def _enqueue(self, future, fn, args, key=None):
+        self._queue.append((future, fn, args, key))
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self.loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        with self._lock:
+            commands, self._queue = self._queue, collections.deque()
+            self._drain_scheduled = False
+            self.stats["drains"] += 1
+        with self.window_ctl.snapshot() if self.window_ctl else contextlib.nullcontext():
+            for future, fn, args, key in commands:
+                if key is not None:
+                    with self._lock:
+                        del self._queries[key]  # from now on, the same query runs again
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    logger.exception(f"Error in X11 worker command {fn.__qualname__}()")
+                    future.set_exception(e)
+                    if isinstance(e, self._connection_errors):
+                        self._connection_lost(e)
+        if self._io_watch:
+            # the events read while the commands waited on replies are queued by Xlib, and no
+            # longer make the display fd readable
+            self.process_events()
@@ -6,31 +6,59 @@ class CompanionAppCtl extends NativeClientCtl {
     this.post("window-action", { appId, action });
   }
 
+  /**
+   * One action for several apps, applied by the companion as a single group
+   * @param {string[] | "all"} appIds
+   */
+  postWindowActions(appIds, action) {
+    this.post("window-action", { appIds, action });
+  }
+
   async postPing() {
     this.post("ping");
   }
 
   async postConfig(config) {
-    this.post("config", { ...config, extensionInstanceId: extensionInstanceId() });
+    // the companion tells the browser profiles apart by this id, see Session in main.py
+    this.post("config", { ...config, extensionInstanceId: await profileInstanceId() });
   }
 
   /**
    * @param {AppItem} app
    */
-  async postAppLauch(app) {
-    this.post("app-launch", {
+  async _appLaunchMessage(app) {
+    return {
+      type: "app-launch",
       appId: app.id,
       windowTitleFingerprint: app.getWindowTitleFingerprint() ?? (await app.getTab())?.title, // TODO: remove
       windowSelector: {
         titleFingerPrint: app.getWindowTitleFingerprint(),
         title: (await app.getTab())?.title,
       },
-    });
+    };
+  }
+
+  /**
+   * @param {AppItem} app
+   */
+  async postAppLauch(app) {
+    this.postBatch([await this._appLaunchMessage(app)]);
+  }
+
+  /**
+   * @param {AppItem[]} apps
+   */
+  async postAppLauchBatch(apps) {
+    this.postBatch(await Promise.all(apps.map((app) => this._appLaunchMessage(app))));
   }
 
   async postAppClose(appId) {
     this.post("app-close", { appId });
   }
+
+  async postStats() {
+    this.post("stats");
+  }
 }
 
 class AppItem {
@@ -125,9 +153,12 @@ class AppItem {
     this._lauched = { tabId, windowId, activeUrl: activeUrl || new RichPromise(null, 5000), cookieStoreId };
   }
 
-  $setNativeWindowIdState({ nativeWindowId }) {
+  $setNativeWindowIdState({ nativeWindowId, state }) {
     if (this._lauched) {
-      this._lauched.nativeWindow = { id: nativeWindowId };
+      // "not-found": the companion gave up waiting for the window, "closed": it is gone,
+      // "claimed": another browser profile served by the same companion manages it
+      const gone = !nativeWindowId || state === "closed";
+      this._lauched.nativeWindow = gone ? null : { id: nativeWindowId, state };
     }
   }
 
@@ -223,22 +254,38 @@ class AppsManager {
     this._companionAppCtl.addEventListener("ping", () => this._companionAppCtl.postPing());
     this._companionAppCtl.addEventListener("ready", () => {});
     this._companionAppCtl.addEventListener("dump", () => {});
+    this._companionAppCtl.addEventListener(
+      "stats",
+      /**@param {any} ev*/ (ev) => {
+        this.companionStats = { ...ev.detail.stats, receivedAt: Date.now() };
+      }
+    );
 
     this._companionAppCtl.addEventListener(
       "<connected>",
-      /**@param {any} ev*/ (ev) => {
+      /**@param {any} ev*/ async (ev) => {
         if (ev.detail.connectionAttempt > 1) {
           console.warn("Companion app reconnected, synchronizing state");
-          this._companionAppCtl.postConfig({ apps: this.apps.map((app) => app.config) });
+          await this._companionAppCtl.postConfig({ apps: this.apps.map((app) => app.config) });
+        }
+        this._companionAppCtl.postAppLauchBatch(this.apps.filter((app) => app.isLaunched));
+      }
+    );
+
+    this._companionAppCtl.addEventListener(
+      "window-action-result",
+      /**@param {any} ev*/ (ev) => {
+        const failed = ev.detail.results.filter((r) => !r.ok);
+        if (failed.length) {
+          console.warn("Window action %s failed for some apps", ev.detail.action, failed);
         }
-        this.apps.forEach((app) => app.isLaunched && this._companionAppCtl.postAppLauch(app));
       }
     );
 
     this._companionAppCtl.addEventListener(
       "window-state",
       /**@param {any} ev*/ (ev) => {
-        this._apps.get(ev.detail.appId)?.$setNativeWindowIdState({ nativeWindowId: ev.detail.nativeWindowId });
+        this._apps.get(ev.detail.appId)?.$setNativeWindowIdState(ev.detail);
       }
     );
     this._reconsile();
@@ -314,7 +361,7 @@ class AppsManager {
       this._apps.delete(appId);
     }
 
-    this._companionAppCtl.postConfig({ apps: config.apps });
+    await this._companionAppCtl.postConfig({ apps: config.apps });
     await this._reconsile();
   }
 
@@ -352,10 +399,23 @@ class AppsManager {
         }
         console.info("Autostarting app", { app });
         await this.launch(app.id, { cookieStoreId: app.config.cookieStoreId });
-        this._companionAppCtl.postWindowAction(app.id, "iconify");
+        return app.id;
       }
     };
-    return Promise.allSettled(Array.from(this._apps.values()).map(_autostart));
+    const results = await Promise.allSettled(Array.from(this._apps.values()).map(_autostart));
+    const launched = results.filter((r) => r.status === "fulfilled" && r.value).map((r) => r.value);
+    if (launched.length) {
+      this._companionAppCtl.postWindowActions(launched, "iconify");
+    }
+    return results;
+  }
+
+  minimizeAll() {
+    this._companionAppCtl.postWindowActions("all", "iconify");
+  }
+
+  requestCompanionStats() {
+    this._companionAppCtl.postStats();
   }
 
   isAppWindow(windowId) {
@@ -577,6 +637,18 @@ browser.runtime.onConnect.addListener(function (port) {
               data: getManagedApps(),
             });
             break;
+          case "getCompanionStats":
+            // latest stats received, and ask for fresh ones: the page polls
+            port.postMessage({
+              type: "return",
+              method: "getCompanionStats",
+              data: appsMgr.companionStats ?? null,
+            });
+            appsMgr.requestCompanionStats();
+            break;
+          case "minimizeAll":
+            appsMgr.minimizeAll();
+            break;
           default:
             console.error("Unknown method", msg["method"]);
         }
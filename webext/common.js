@@ -70,6 +70,10 @@ class NativeClientCtl extends EventTarget {
     nativePort.onMessage.addListener((msg) => {
       const type = msg["type"] ?? "<unknown>";
       console.debug("[DBG] Received message from native port %s | type: %s", this.id, type, msg);
+      if (type === "batch") {
+        // combined reply of a batch: dispatch the sub-replies in order
+        msg.messages.forEach((m) => this.dispatchEvent(new CustomEvent(m["type"] ?? "<unknown>", { detail: m })));
+      }
       this.dispatchEvent(new CustomEvent(type, { detail: msg }));
 
       if (!nativePort.error) {
@@ -91,6 +95,20 @@ class NativeClientCtl extends EventTarget {
     console.debug("[DBG] Posting message to native port %s | type:%s", this.id, type, msg);
     this.nativePort.postMessage({ type, ...msg });
   }
+
+  /**
+   * Posts several messages as one `batch` message, handled in order by the native client
+   * @param {{type: string}[]} messages
+   */
+  postBatch(messages) {
+    if (messages.length === 1) {
+      const { type, ...msg } = messages[0];
+      return this.post(type, msg);
+    }
+    if (messages.length) {
+      this.post("batch", { messages });
+    }
+  }
 }
 
 class RichPromise extends Promise {
@@ -154,3 +172,23 @@ function extensionId() {
 function extensionInstanceId() {
   return new URL(browser.runtime.getURL("")).host;
 }
+
+let _profileInstanceId;
+
+/**
+ * Random id of this install of the extension, kept in storage.local. Unlike extensionInstanceId(),
+ * which is the extension id on Chromium, it differs between the profiles of a browser
+ * @returns {Promise<string>}
+ */
+function profileInstanceId() {
+  _profileInstanceId ??= (async () => {
+    const { profileInstanceId } = await browser.storage.local.get(["profileInstanceId"]);
+    if (profileInstanceId) {
+      return profileInstanceId;
+    }
+    const id = crypto.randomUUID();
+    await browser.storage.local.set({ profileInstanceId: id });
+    return id;
+  })();
+  return _profileInstanceId;
+}